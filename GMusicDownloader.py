@@ -1,118 +1,17 @@
-import json
-import os
+import Queue
 import tkFileDialog
 import Tkinter
 import ttk
-from urllib2 import urlopen
-from datetime import datetime as dt
 
-from eyed3.id3.frames import ImageFrame
-from eyed3.mp3 import Mp3AudioFile
 from gmusicapi import Mobileclient
 import auth
+import downloader
+import library
 import shared
+import streaming
 
-
-def filename_template(track):
-    """
-    Formats template for naming a downloaded file
-    :param track: dict containing track info
-    :return: filename string
-    """
-    if 'trackNumber' in track:
-        date_or_tracknumber = str(track['trackNumber'])
-    else:
-        date_or_tracknumber = dt.fromtimestamp(int(track['publicationTimestampMillis'])/1000).strftime('%Y_%m_%d')
-    track_title = track['title'].replace('/', '_').replace('=', '_')
-    track_album = track['album'].replace('/', '_').replace('=', '_')
-    track_artist = track['artist'].replace('/', '_').replace('=', '_')
-    #return str(track['trackNumber']) + "-" + track_title + "-" + track_album + "-" + track_artist + ".mp3"
-    return date_or_tracknumber + "-" + track_title + "-" + track_album + "-" + track_artist + ".mp3"
-
-
-def get_image_tuple_from_url(url):
-    """
-    Gets an album or artist image from the given url.
-    :param url: URL of the album/artist image
-    :return: tuple containing mime-type and image data
-    """
-    response = urlopen(url)
-    mime_type = response.info().type
-    image_bytes = response.read()
-    return mime_type, image_bytes
-
-
-def download_track(track, path='', mobile_client=None, device_id=None):
-    """
-    Downloads the mp3 file of the given track
-    :param track: Track dict
-    :param path: Path to download to. If omitted, then will download to current working directory.
-    :return: None
-    """
-    if 'id' in track:
-        track_id = track['id']
-    elif 'storeId' in track:
-        track_id = track['storeId']
-    elif 'episodeId' in track:
-        track_id = track['episodeId']
-    else:
-        print 'Problem with track info...'
-        print track
-        return
-    try:
-        #stream_url = mobile_client.get_stream_url(track_id, device_id)
-        if 'episodeId' in track:
-            stream_url = mobile_client.get_podcast_episode_stream_url(track_id, device_id)
-        else:
-            stream_url = mobile_client.get_stream_url(track_id, device_id)
-        song_bytes = urlopen(stream_url).read()
-    except Exception, e:
-        print "Error retrieving track: " + track['title']
-        print "Error: ", e
-        return
-
-    output_file = open(os.path.join(path, filename_template(track)), "wb")
-    output_file.write(song_bytes)
-    output_file.close()
-    id3 = Mp3AudioFile(output_file.name)
-    id3.initTag()
-    id3.tag.title = track['title']
-    id3.tag.artist = track['artist']
-    id3.tag.album = track['album']
-    id3.tag.album_artist = track['albumArtist']
-    if 'genre' in track:
-        genre = track['genre']
-    else:
-        genre = u'Podcast'
-    id3.tag.genre = genre
-    if 'year' in track:
-        year_int = int(track['year'])
-    else:
-        year_int = 0
-    if year_int != 0:
-        id3.tag.release_date = year_int
-        id3.tag.original_release_date = year_int
-        id3.tag.recording_date = year_int
-    if 'trackNumber' in track:
-        track_number = track['trackNumber']
-    else:
-        track_number = 0
-    id3.tag.track_num = track_number
-    if 'discNumber' in track:
-        disc_number = track['discNumber']
-    else:
-        disc_number = 1
-    id3.tag.disc_num = disc_number
-    if 'albumArtRef' in track:
-        mime_type, image_data = get_image_tuple_from_url(track['albumArtRef'][0]['url'])
-        id3.tag.images.set(ImageFrame.FRONT_COVER, image_data, mime_type)
-    elif 'artistArtRef' in track:
-        mime_type, image_data = get_image_tuple_from_url(track['artistArtRef'][0]['url'])
-        id3.tag.images.set(ImageFrame.FRONT_COVER, image_data, mime_type)
-    elif 'art' in track:
-        mime_type, image_data = get_image_tuple_from_url(track['art'][0]['url'])
-        id3.tag.images.set(ImageFrame.FRONT_COVER, image_data, mime_type)
-    id3.tag.save()
+LIBRARY_POLL_INTERVAL = 200
+DOWNLOAD_POLL_INTERVAL = 100
 
 
 class MainWindow(shared.Centerable, Tkinter.Tk):
@@ -131,7 +30,13 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         self.resizable(0, 0)
         #self.mobile_client = mobile_client
         self.device_id = None
-        self.library = mobile_client.get_all_songs()
+        self.audio_cache = streaming.AudioCache()
+        self.download_engine = None
+        self.download_plan = None
+        self.progress = None
+        self.downloads_done = 0
+        self.download_failures = 0
+        self.library, self.library_loader = library.open_library(mobile_client)
 
         # Initializes the gui widgets. Should only be called from the __init__function.
         self.grid()
@@ -142,18 +47,24 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         self.tree = tree = ttk.Treeview(self, height=30, yscrollcommand=tracklist_scrollbar.set)
         tree.column("#0", width=750)
         tracklist_scrollbar.config(command=tree.yview)
-        download_button = Tkinter.Button(self, text="Download", state="normal", command=self.on_download_press)
+        self.download_button = Tkinter.Button(self, text="Download", state="normal", command=self.on_download_press)
+        self.sync_var = Tkinter.IntVar(self, value=1)
+        self.sync_checkbox = Tkinter.Checkbutton(self, text="Skip tracks already downloaded to the folder",
+                                                 variable=self.sync_var)
 
         # place widgets on grid
         tracklist_frame.grid(column=0, row=0, rowspan=1, sticky='NS')
         self.tree.grid(in_=tracklist_frame, column=0, row=0, sticky='NS')
         tracklist_scrollbar.grid(in_=tracklist_frame, column=1, row=0, sticky='NS')
-        download_button.grid(column=0, row=1, sticky='EW')
+        self.download_button.grid(column=0, row=1, sticky='EW')
+        self.sync_checkbox.grid(column=0, row=2, sticky='W')
 
-        self.fill_tree(self.library)
-        self.center()
-        splash.master.destroy()
-        self.device_chooser = shared.ChooseDevice(self, mobile_client)
+        if len(self.library) > 0:
+            self.fill_tree(self.library)
+            self.show_window()
+        else:
+            self.withdraw()
+        self.after(LIBRARY_POLL_INTERVAL, self.check_library_loader)
 
     # def center(self):
     #     """
@@ -168,15 +79,46 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
     #     y = h/2 - size[1]/2
     #     self.geometry("+%d+%d" % (x, y))
 
-    def fill_tree(self, tracks):
+    def show_window(self):
         """
+        Replaces the splash with the main window.
+        :return: None
+        """
+        self.deiconify()
+        self.center()
+        splash.master.destroy()
+        self.device_chooser = shared.ChooseDevice(self, mobile_client)
 
+    def check_library_loader(self):
         """
-        tracks.sort(key=lambda trk: trk['title'])
-        tracks.sort(key=lambda trk: trk['trackNumber'])
-        tracks.sort(key=lambda trk: trk['discNumber'])
-        tracks.sort(key=lambda trk: trk['album'])
-        tracks.sort(key=lambda trk: trk['albumArtist'])
+        Virtual loop that waits for the library to finish loading. A full download is shown once complete, while
+        changes found by the background sync of a saved library refill the tree.
+        :return: None
+        """
+        loader = self.library_loader
+        loader.receive(self.library)
+        if not loader.done:
+            if loader.full:
+                splash.set_message('GMusicDownloader\nis loading...\n' + str(loader.loaded) + ' tracks')
+            self.after(LIBRARY_POLL_INTERVAL, self.check_library_loader)
+            return
+        merged = loader.finish(self.library)
+        self.library_loader = None
+        if loader.full:
+            self.fill_tree(self.library)
+            self.show_window()
+        elif merged is not None:
+            self.library = merged
+            self.tree.delete(*self.tree.get_children())
+            self.fill_tree(self.library)
+
+    def fill_tree(self, tracks):
+        """
+        Fills the tree with artist, album and track items.
+        :param tracks: TrackTable or list of TrackRefs from self.library
+        :return: None
+        """
+        tracks = sorted(tracks, key=self.library.sort_key(library.ALBUM_ARTIST_ORDER))
         #print(tracks[0])
         for track in tracks:
             #print(track['title'])
@@ -203,7 +145,7 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
             except Tkinter.TclError:
                 pass
             self.tree.insert(album_label + artist_label, 'end', track['title'] + track['id'], text=track['title'],
-                             values=(json.dumps(track),))
+                             values=('track:' + str(track.handle),))
 
     # def filename_template(self, track):
     #     """
@@ -237,78 +179,91 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         base_dir = tkFileDialog.askdirectory(master=self)
         if not base_dir:
             return
-        steps_number = self.count_steps()
-        progress = ProgressWindow(self, 0, steps_number)
+        self.download_plan = plan = self.plan_downloads(base_dir)
+        if len(plan) == 0:
+            return
+        self.progress = progress = ProgressWindow(self, 0, len(plan))
         progress.set_message('Downloading...')
         progress.center()
-        for selected_item in self.tree.selection():
-            values = self.tree.item(selected_item)['values']
-            data = values[0]
-            if data.startswith('artist:'):
-                progress.steps_complete(1)
-                artist_name = data.split(':', 1)[1].replace('/', '_').replace('=', '_')
-                progress.set_message('Retreiving: ' + artist_name)
-                albums = self.tree.get_children(selected_item)
-                for album in albums:
-                    album_item = self.tree.item(album)
-                    #print(album_item)
-                    album_name = album_item['values'][0].split(':', 1)[1].replace('/', '_').replace('=', '_')
-                    progress.set_message('Retrieving: ' + album_name)
-                    try:
-                        os.makedirs(os.path.join(base_dir, artist_name, album_name))
-                    except OSError:
-                        print "Directory already exists. Skipping directory creation.\n" + album_name
-                    progress.steps_complete(1)
-                    tracks = self.tree.get_children(album)
-                    for track_child in tracks:
-                        track_item = self.tree.item(track_child)
-                        track_data = track_item['values'][0]
-                        track = json.loads(track_data)
-                        progress.set_message('Retrieving: ' + track['title'])
-                        download_track(track, os.path.join(base_dir, artist_name, album_name),
-                                       mobile_client=mobile_client, device_id=self.device_id)
-                        progress.steps_complete(1)
-            elif data.startswith('album:'):
-                progress.steps_complete(1)
-                album_name = data.split(':', 1)[1].replace('/', '_').replace('=', '_')
-                progress.set_message('Retreiving: ' + album_name)
-                try:
-                    os.makedirs(os.path.join(base_dir, album_name))
-                except OSError:
-                    print "Directory already exists. Skipping directory creation.\n" + album_name
-                progress.steps_complete(1)
-                tracks = self.tree.get_children(selected_item)
-                for track_child in tracks:
-                    track_item = self.tree.item(track_child)
-                    track_data = track_item['values'][0]
-                    track = json.loads(track_data)
-                    progress.set_message('Retreiving: ' + track['title'])
-                    #self.download_track(track, os.path.join(base_dir, album_name))
-                    download_track(track, os.path.join(base_dir, album_name), mobile_client=mobile_client,
-                                   device_id=self.device_id)
-                    progress.steps_complete(1)
+        self.download_button['state'] = 'disabled'
+        self.download_engine = engine = downloader.DownloadEngine()
+        manifest = None
+        if self.sync_var.get():
+            manifest = downloader.Manifest(base_dir)
+        self.downloads_done = 0
+        self.download_failures = 0
+        plan.submit(engine, mobile_client=mobile_client, device_id=self.device_id, audio_cache=self.audio_cache,
+                    manifest=manifest, covers=downloader.CoverCache())
+        self.after(DOWNLOAD_POLL_INTERVAL, self.check_downloads)
+
+    def check_downloads(self):
+        """
+        Virtual loop that follows the progress of the download engine, closing the progress window once every track
+        is done.
+        :return: None
+        """
+        engine = self.download_engine
+        while True:
+            try:
+                report = engine.progress.get_nowait()
+            except Queue.Empty:
+                break
+            if report[0] == 'started':
+                self.progress.set_message('Retrieving: ' + self.download_plan.get_track(report[1])['title'])
             else:
-                track = json.loads(data)
-                #print track['title']
-                progress.set_message('Retreiving: ' + track['title'])
-                #self.download_track(track, base_dir)
-                download_track(track, base_dir, mobile_client=mobile_client, device_id=self.device_id)
-                progress.steps_complete(1)
-        progress.destroy()
-
-    def count_steps(self):
+                self.downloads_done += 1
+                if not report[2]:
+                    self.download_failures += 1
+                self.progress.steps_complete(1)
+        if self.downloads_done < engine.total:
+            self.after(DOWNLOAD_POLL_INTERVAL, self.check_downloads)
+            return
+        engine.shutdown()
+        self.download_engine = None
+        self.download_plan = None
+        self.progress.destroy()
+        self.progress = None
+        self.download_button['state'] = 'normal'
+        if self.download_failures > 0:
+            print(str(self.download_failures) + ' tracks failed to download')
+
+    def get_tree_track(self, data):
         """
+        Gets the library track that a track item in the tree refers to.
+        :param data: value of the tree item, in the form track:<handle>
+        :return: TrackRef
+        """
+        return self.library[int(data.split(':', 1)[1])]
 
+    def plan_downloads(self, base_dir):
+        """
+        Turns the selection in the tree into a download plan. Artists are planned before albums and albums before
+        tracks, so when an item and something inside it are both selected, the tracks go where the outer item puts
+        them and are downloaded once.
+        :param base_dir: destination directory
+        :return: downloader.DownloadPlan
         """
-        count = 0
-        selection = self.tree.selection()
+        plan = downloader.DownloadPlan(base_dir)
+        kinds = ('artist', 'album', 'track')
+        selection = sorted(self.tree.selection(),
+                           key=lambda item: kinds.index(self.tree.item(item)['values'][0].split(':', 1)[0]))
         for selected_item in selection:
-            count += 1
-            for child in self.tree.get_children(selected_item):
-                count += 1
-                for grandchild in self.tree.get_children(child):
-                    count += 1
-        return count
+            data = self.tree.item(selected_item)['values'][0]
+            if data.startswith('artist:'):
+                artist_name = data.split(':', 1)[1]
+                for album in self.tree.get_children(selected_item):
+                    album_name = self.tree.item(album)['values'][0].split(':', 1)[1]
+                    for track_child in self.tree.get_children(album):
+                        track = self.get_tree_track(self.tree.item(track_child)['values'][0])
+                        plan.add(track, artist_name, album_name)
+            elif data.startswith('album:'):
+                album_name = data.split(':', 1)[1]
+                for track_child in self.tree.get_children(selected_item):
+                    track = self.get_tree_track(self.tree.item(track_child)['values'][0])
+                    plan.add(track, album_name)
+            else:
+                plan.add(self.get_tree_track(data))
+        return plan
 
     # def download_track(self, track, path=''):
     #     """
@@ -0,0 +1,253 @@
+#!/usr/bin/python
+"""
+Downloads tracks from a Google Play Music account without opening any windows. Progress is written to stdout as
+json lines, one object per event, and everything else is written to stderr.
+
+Example:
+    GMusicDownloaderCLI.py --device-id 0123456789abcdef --dest ~/Music --artist 'Daft Punk' --playlist Running
+"""
+import argparse
+import json
+import os
+import Queue
+import sys
+
+from gmusicapi import Mobileclient
+import credentials
+import downloader
+import library
+
+# Environment variable the password is taken from when the credentials are not cached
+PASSWORD_VARIABLE = 'GMUSIC_PASSWORD'
+# Seconds between checks for an interrupt while waiting on the downloads
+PROGRESS_TIMEOUT = 1
+# Exit status when some tracks failed to download, and when nothing could be downloaded at all
+EXIT_FAILED = 1
+EXIT_ERROR = 2
+
+
+def matches(value, names):
+    """
+    Checks a field value against names given on the command line, ignoring case and surrounding spaces.
+    :param value: field value
+    :param names: set of lowercase names
+    :return: boolean
+    """
+    return value.strip().lower() in names
+
+
+class Selection(downloader.DownloadPlan):
+    """
+    Download plan filled from the command line selectors, remembering the names that matched nothing. A track
+    picked by more than one selector goes to the directory of the first one.
+    """
+    def __init__(self, base_dir):
+        """
+        Selection __init__ function
+        :param base_dir: destination directory
+        :return: None
+        """
+        downloader.DownloadPlan.__init__(self, base_dir)
+        self.unmatched = []
+
+    def add_library(self, tracks, artists, albums, everything):
+        """
+        Adds library tracks by album artist or album. Albums are grouped by artist like the downloader window does
+        when an artist is selected, and put straight under base_dir when they are selected by themselves.
+        :param tracks: TrackTable of library tracks
+        :param artists: album artist names
+        :param albums: album names
+        :param everything: True to add the whole library
+        :return: None
+        """
+        artist_names = set(artist.strip().lower() for artist in artists)
+        album_names = set(album.strip().lower() for album in albums)
+        found = set()
+        ordered = sorted(tracks, key=tracks.sort_key(library.ALBUM_ARTIST_ORDER))
+        for track in ordered:
+            artist, album = track.get('albumArtist', u''), track.get('album', u'')
+            if everything or matches(artist, artist_names):
+                self.add(track, artist, album)
+                found.add(artist.strip().lower())
+        for track in ordered:
+            album = track.get('album', u'')
+            if matches(album, album_names):
+                self.add(track, album)
+                found.add(album.strip().lower())
+        self.unmatched.extend(name for name in list(artists) + list(albums) if name.strip().lower() not in found)
+
+    def add_playlists(self, mobile_client, tracks, names):
+        """
+        Adds the tracks of playlists, each into a directory named after the playlist.
+        :param mobile_client: GMusicAPI Mobileclient instance
+        :param tracks: TrackTable of library tracks
+        :param names: playlist names
+        :return: None
+        """
+        playlist_names = set(name.strip().lower() for name in names)
+        found = set()
+        for playlist in mobile_client.get_all_user_playlist_contents():
+            if playlist['name'] != '' and matches(playlist['name'], playlist_names):
+                found.add(playlist['name'].strip().lower())
+                for track in library.resolve_playlist(tracks, playlist['tracks']):
+                    self.add(track, playlist['name'])
+        self.unmatched.extend(name for name in names if name.strip().lower() not in found)
+
+    def add_podcasts(self, mobile_client, device_id, names):
+        """
+        Adds the episodes of podcast series, each into a directory named after the series.
+        :param mobile_client: GMusicAPI Mobileclient instance
+        :param device_id: mobile device id
+        :param names: podcast series titles
+        :return: None
+        """
+        series_names = set(name.strip().lower() for name in names)
+        chosen = {}
+        for podcast in mobile_client.get_all_podcast_series(device_id):
+            if matches(podcast['title'], series_names):
+                chosen[podcast['seriesId']] = podcast
+        if chosen:
+            for episode in mobile_client.get_all_podcast_episodes(device_id):
+                podcast = chosen.get(episode['seriesId'])
+                if podcast is not None:
+                    episode['artist'] = podcast['author']
+                    episode['albumArtist'] = podcast['author']
+                    episode['album'] = episode['seriesTitle']
+                    self.add(episode, podcast['title'])
+        found = set(podcast['title'].strip().lower() for podcast in chosen.itervalues())
+        self.unmatched.extend(name for name in names if name.strip().lower() not in found)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Download tracks from Google Play Music without a window.')
+    parser.add_argument('--artist', action='append', default=[], help='album artist to download, can be repeated')
+    parser.add_argument('--album', action='append', default=[], help='album to download, can be repeated')
+    parser.add_argument('--playlist', action='append', default=[], help='playlist to download, can be repeated')
+    parser.add_argument('--podcast', action='append', default=[],
+                        help='podcast series to download, can be repeated')
+    parser.add_argument('--all', action='store_true', help='download the whole library')
+    parser.add_argument('--dest', required=True, help='directory to download to')
+    parser.add_argument('--device-id', required=True, help='id of a mobile device registered with the account')
+    parser.add_argument('--email', help='account to log in with, instead of the cached one. The password is taken '
+                                        'from the ' + PASSWORD_VARIABLE + ' environment variable')
+    parser.add_argument('--workers', type=int, default=downloader.DOWNLOAD_WORKERS,
+                        help='tracks downloaded at the same time')
+    parser.add_argument('--max-per-host', type=int, default=downloader.MAX_PER_HOST,
+                        help='connections allowed to any one host')
+    parser.add_argument('--cover-size', type=int, default=downloader.COVER_SIZE,
+                        help='largest width and height of the embedded covers, 0 to embed them as served')
+    parser.add_argument('--no-sync', action='store_true',
+                        help='download every track again, even if it is already in the destination')
+    args = parser.parse_args(argv)
+    if not (args.all or args.artist or args.album or args.playlist or args.podcast):
+        parser.error('nothing to download, give --all, --artist, --album, --playlist or --podcast')
+    if args.workers < 1 or args.max_per_host < 1:
+        parser.error('--workers and --max-per-host must be at least 1')
+    if args.cover_size < 0:
+        parser.error('--cover-size cannot be negative')
+    return args
+
+
+def get_credentials(email):
+    """
+    Gets the credentials to log in with, from the environment or from the cache of the login window.
+    :param email: account given on the command line, or None to use the cached one
+    :return: tuple of username and password, or None if there is no password for the account
+    """
+    password = os.environ.get(PASSWORD_VARIABLE)
+    cached = credentials.load_cached_credentials()
+    if email is None:
+        if cached is None:
+            return None
+        email = cached[0]
+    if password is None:
+        if cached is None or cached[0] != email:
+            return None
+        password = cached[1]
+    return email, password
+
+
+def main(argv):
+    """
+    Runs a batch download.
+    :param argv: command line arguments
+    :return: exit status, 0 if every track was downloaded or already there
+    """
+    args = parse_args(argv)
+    channel = sys.stdout
+    sys.stdout = sys.stderr  # Anything the download functions print must not get mixed into the progress
+
+    def send(event, **values):
+        values['event'] = event
+        channel.write(json.dumps(values) + '\n')
+        channel.flush()
+
+    login = get_credentials(args.email)
+    if login is None:
+        send('error', message='No credentials. Log in once with the downloader window, or give --email and set ' +
+                              PASSWORD_VARIABLE)
+        return EXIT_ERROR
+    mobile_client = Mobileclient(debug_logging=False)
+    if not mobile_client.login(login[0], login[1], Mobileclient.FROM_MAC_ADDRESS):
+        send('error', message='Login failed')
+        return EXIT_ERROR
+
+    base_dir = os.path.abspath(os.path.expanduser(args.dest))
+    selection = Selection(base_dir)
+    try:
+        if args.all or args.artist or args.album or args.playlist:
+            tracks, error = library.load_library(mobile_client)
+            if error is not None:
+                send('error', message='Library did not load completely: ' + str(error))
+                return EXIT_ERROR
+            selection.add_library(tracks, args.artist, args.album, args.all)
+            if args.playlist:
+                selection.add_playlists(mobile_client, tracks, args.playlist)
+        if args.podcast:
+            selection.add_podcasts(mobile_client, args.device_id, args.podcast)
+    except Exception, e:
+        send('error', message='Could not get the tracks to download: ' + str(e))
+        return EXIT_ERROR
+    if selection.unmatched:
+        send('error', message='Nothing found for: ' + ', '.join(selection.unmatched))
+        return EXIT_ERROR
+
+    manifest = None
+    if not args.no_sync:
+        # Kept in the destination like the downloader window does, so either one skips what the other downloaded
+        manifest = downloader.Manifest(base_dir)
+    engine = downloader.DownloadEngine(args.workers, args.max_per_host)
+    covers = downloader.CoverCache(args.cover_size or None)
+    selection.submit(engine, mobile_client=mobile_client, device_id=args.device_id, manifest=manifest,
+                     covers=covers)
+    send('planned', total=engine.total)
+
+    done = 0
+    failed = 0
+    try:
+        while done < engine.total:
+            try:
+                report = engine.progress.get(timeout=PROGRESS_TIMEOUT)
+            except Queue.Empty:
+                continue
+            path = report[1]
+            track = selection.get_track(path)
+            track_id = library.get_track_id(track)
+            if report[0] == 'started':
+                send('started', id=track_id, title=track['title'], path=path)
+            else:
+                done += 1
+                if not report[2]:
+                    failed += 1
+                send('finished', id=track_id, title=track['title'], path=path, ok=report[2], done=done,
+                     total=engine.total)
+    except KeyboardInterrupt:
+        send('interrupted', done=done, failed=failed, total=engine.total)
+        return EXIT_FAILED
+    engine.shutdown()
+    send('summary', total=engine.total, ok=done - failed, failed=failed)
+    return EXIT_FAILED if failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
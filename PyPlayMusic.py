@@ -1,25 +1,28 @@
 #!/usr/bin/python
-import io
-from PIL import Image, ImageTk
+import imp
+from PIL import ImageTk
 import random
-import re
 import sys
 import tkFont
 import Tkinter
 import ttk
-from urllib2 import urlopen
 
 from gmusicapi import Mobileclient
 
+import art
 import auth
-import GMusicDownloader
+import buffering
+import downloader
+import library
 import shared
+import streaming
+from player_host import RemotePlayer
 args = sys.argv
 if len(args) > 1:
     backend = args[1]
     try:
-        backend_module = __import__('player_' + backend, fromlist=['Player'])
-        Player = getattr(backend_module, 'Player')
+        imp.find_module('player_' + backend)
+        backends = ['player_' + backend]
     except ImportError, error:
         print(str(error))
         print('Backend, ' + backend + ', not found.')
@@ -27,14 +30,21 @@ if len(args) > 1:
         print('either an invalid backend was entered or the file is missing.')
         sys.exit(1)
 else:
-    try:
-        from player import Player
-    except ImportError:
-        from player_vlc import Player
+    # The backend runs in a player host process, which falls back to VLC if GStreamer cannot be loaded
+    backends = ['player', 'player_vlc']
 
 # Module constants
+TITLE = 'PyPlayMusic'
 DEFAULT_IMAGE = "PyPlayMusicIcon.png"
 LOOP_INTERVAL = 100
+# Milliseconds between handling the messages of the player host while nothing is playing
+PLAYER_POLL_INTERVAL = 200
+MAX_LOOP_INTERVAL = 500
+LIBRARY_POLL_INTERVAL = 200
+SEARCH_DELAY = 250
+LISTBOX_CHUNK = 200
+PRERESOLVE_COUNT = 3
+ART_POLL_INTERVAL = 50
 
 
 def convert_milli_to_std(millisecs):
@@ -139,6 +149,23 @@ class TrackList(list):
     def current(self):
         return self[self.pos]
 
+    def peek_next(self):
+        """
+        Gets the track that next would move to, without moving the pointer.
+        :return: next track
+        """
+        if self.pos == len(self) - 1:
+            return self[0]
+        return self[self.pos + 1]
+
+    def upcoming(self, count):
+        """
+        Gets the tracks that the next count calls to next would return, without moving the pointer.
+        :param count: number of tracks
+        :return: list of tracks
+        """
+        return [self[(self.pos + offset) % len(self)] for offset in range(1, min(count, len(self) - 1) + 1)]
+
 
 class MainWindow(shared.Centerable, Tkinter.Tk):
     """
@@ -151,13 +178,34 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         """
         Tkinter.Tk.__init__(self)
         self.default_image = ImageTk.PhotoImage(file=DEFAULT_IMAGE, master=self)
+        self.shown_image = self.default_image
+        self.art_cache = art.ArtCache(self)
+        self.art_url = None
+        self.art_job = None
         self.parent = None
-        self.player = Player()
+        self.player = RemotePlayer(backends)
+        self.player.connect('track-changed', lambda: self.on_track_changed(self.playing_tracks))
+        self.player.connect('duration-changed', self.on_duration_changed)
+        self.player.connect('eos', self.on_player_eos)
         self.listbox_tracks = None
+        self.playing_tracks = None
+        self.search_job = None
+        self.listbox_fill_job = None
+        self.stream_resolver = streaming.StreamResolver(mobile_client)
+        self.audio_cache = streaming.AudioCache()
+        self.buffer_server = buffering.BufferServer(self.audio_cache, self.get_stream_url)
+        self.preload = None
+        self.queued_url = None
+        self.underruns = 0
+        self.loop_job = None
         self.playlists = None
         self.stations = None
         self.device_id = None
         self.library = None
+        self.library_loader = None
+        self.search_index = None
+        self.window_shown = False
+        self.exit_status = 0
 
         # Initialize the GUI
         self.protocol('WM_DELETE_WINDOW', self.close_window)
@@ -173,6 +221,7 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         self.search_choose.current(0)
         self.search_choose.bind("<<ComboboxSelected>>", self.on_search_choose_click)
         self.entry_variable = Tkinter.StringVar(search_frame)
+        self.entry_variable.trace('w', self.on_entry_change)
         self.entry = Tkinter.Entry(search_frame, textvariable=self.entry_variable)
         self.entry.bind("<Return>", self.on_press_enter)
         self.entry.bind("<KP_Enter>", self.on_press_enter)
@@ -227,7 +276,8 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
 
         self.entry.focus_set()
 
-        self.library = mobile_client.get_all_songs()
+        self.library, self.library_loader = library.open_library(mobile_client)
+        self.search_index = library.SearchIndex(self.library)
 
         def key(event):
             keysym = event.keysym_num
@@ -253,12 +303,16 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
                 self.seek_reverse(30)
 
         self.fileinfo.bind("<Key>", key)
-        self.fileinfo.bind("<Control-d>", lambda x: self.on_track_download(self.listbox_tracks.current()))
+        self.fileinfo.bind("<Control-d>", lambda x: self.on_track_download(self.playing_tracks.current()))
 
         # Final Commands
-        self.center()
-        splash.master.destroy()
-        shared.ChooseDevice(self, mobile_client)
+        if len(self.library) > 0:
+            self.library.get_rank(library.ARTIST_ORDER)
+            self.show_window()
+        else:
+            self.withdraw()
+        self.after(LIBRARY_POLL_INTERVAL, self.check_library_loader)
+        self.after(PLAYER_POLL_INTERVAL, self.poll_player)
 
     # def center(self):
     #     """
@@ -288,6 +342,67 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         """
         self.player_state = "stopped"
         self.player.stop()
+        self.player.close()
+        self.buffer_server.shutdown()
+
+    def poll_player(self):
+        """
+        Virtual loop handling the messages of the player host, so they do not pile up while the play loop is not
+        running. Closes the application if the host could not load a backend.
+        :return: None
+        """
+        self.player.poll()
+        if self.player.failed is not None:
+            print('The player backend could not be loaded. Check that GStreamer or VLC and its python bindings are '
+                  'installed.')
+            self.exit_status = 1
+            if not self.window_shown:
+                splash.master.destroy()
+            self.close_window()
+            return
+        self.after(PLAYER_POLL_INTERVAL, self.poll_player)
+
+    def show_window(self):
+        """
+        Replaces the splash with the main window once there are tracks to search.
+        :return: None
+        """
+        self.window_shown = True
+        self.deiconify()
+        self.center()
+        splash.master.destroy()
+        shared.ChooseDevice(self, mobile_client)
+
+    def check_library_loader(self):
+        """
+        Virtual loop that adds the pages of the library to the search index as they arrive, and applies the changes
+        found by the background sync when the library was opened from the snapshot.
+        :return: None
+        """
+        loader = self.library_loader
+        if loader.receive(self.library):
+            self.search_index.update()
+            if self.window_shown and self.listbox_tracks is not self.playing_tracks:
+                self.preview_search()
+        if not loader.done:
+            status = 'Loading library... ' + str(loader.loaded) + ' tracks'
+            if not self.window_shown:
+                splash.set_message('PyPlayMusic is loading...\n' + status)
+                if len(self.library) > 0:
+                    self.show_window()
+            elif loader.full:
+                self.title(TITLE + ' - ' + status)
+            self.after(LIBRARY_POLL_INTERVAL, self.check_library_loader)
+            return
+        merged = loader.finish(self.library)
+        self.library_loader = None
+        if merged is not None:
+            self.library = merged
+            self.search_index = library.SearchIndex(self.library)
+        self.library.get_rank(library.ARTIST_ORDER)
+        self.title(TITLE)
+        if not self.window_shown:
+            self.show_window()
 
     def on_search_choose_click(self, event):
         """
@@ -320,6 +435,7 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
             self.entry['state'] = "normal"
             self.search_button['state'] = "normal"
             self.randomize_list['state'] = "normal"
+            self.on_entry_change()
 
     def on_playlists_click(self, event):
         """
@@ -402,35 +518,65 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         """
         self.on_search_click()
 
+    def on_entry_change(self, *args):
+        """
+        Callback function called when the search text changes. Waits SEARCH_DELAY milliseconds for more typing
+        before showing the matches.
+        :param args: Tk variable trace arguments
+        :return: None
+        """
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(SEARCH_DELAY, self.preview_search)
+
+    def preview_search(self):
+        """
+        Shows the tracks matching the current search text in the track listbox without playing them.
+        :return: None
+        """
+        self.search_job = None
+        if self.search_index is None or self.entry['state'] == "disabled":
+            return
+        if self.entry_variable.get() == '':
+            if self.playing_tracks is not None and self.listbox_tracks is not self.playing_tracks:
+                self.fill_track_listbox(self.playing_tracks)
+            return
+        search_tracks = self.get_search_tracks()
+        if search_tracks != self.listbox_tracks:
+            self.fill_track_listbox(search_tracks)
+
+    def get_search_tracks(self):
+        """
+        Searches the library with the current search text.
+        :return: TrackList of matching tracks in artist, album, disc and track order
+        """
+        search_tracks = TrackList(self.search_index.search(self.get_search_field(), self.entry_variable.get()))
+        search_tracks.sort(key=self.library.sort_key(library.ARTIST_ORDER))
+        return search_tracks
+
     def on_search_click(self):
         """
         Callback function called when "Search" button is clicked.
         :return: None
         """
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+            self.search_job = None
         self.player_state = "new_search"
         self.enable_controls(False)
         self.player.stop()
-        search_tracks = TrackList([track for track in self.library
-                                   if self.track_matches(track)])
+        search_tracks = self.get_search_tracks()
         if len(search_tracks) == 0:
-            global next_image
             self.progress['value'] = 0
             self.current_time['text'] = "0:00"
             self.total_time['text'] = "0:00"
             self.fill_track_listbox(search_tracks)
-            next_image = self.default_image
-            self.album_image.configure(image=next_image)
+            self.show_image(self.default_image)
             self.fileinfo['text'] = "Nothing matched your search!"
             return
 
         if self.rand_list_var.get():
             random.shuffle(search_tracks)
-        else:
-            search_tracks.sort(key=lambda trk: trk['title'])
-            search_tracks.sort(key=lambda trk: trk['trackNumber'])
-            search_tracks.sort(key=lambda trk: trk['discNumber'])
-            search_tracks.sort(key=lambda trk: trk['album'])
-            search_tracks.sort(key=lambda trk: trk['artist'])
 
         self.play(search_tracks)
 
@@ -440,24 +586,21 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         """
         self.fileinfo.focus()
 
-    def track_matches(self, track):
+    def get_search_field(self):
         """
-        Determines if the given track matches the search parameters.
-        :param track: TrackList track
-        :return: MatchObject or None but typically treated like True and False respectively.
+        Gets the track field chosen in the "Search by" dropdown.
+        :return: name of the track field to search
         """
         current_search_index = self.search_choose.current()
         current_search = self.search_choose['values'][current_search_index]
         if current_search == "Search by Artist":
-            search_field = track['artist']
+            return 'artist'
         elif current_search == "Search by Genre":
-            search_field = track['genre']
+            return 'genre'
         elif current_search == "Search by Title":
-            search_field = track['title']
+            return 'title'
         else:
-            search_field = track['album']
-
-        return re.search(self.entry_variable.get().replace(' ', '|'), search_field, flags=re.I)
+            return 'album'
 
     def pause_track(self):
         """
@@ -471,6 +614,7 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         else:
             self.player.unpause()
             self.pause_state = "unpaused"
+        self.wake_play_loop()
 
     def on_next_track(self):
         """
@@ -482,6 +626,7 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         self.search_button['state'] = "disabled"
         self.player.stop()
         self.player_state = "next"
+        self.wake_play_loop()
 
     def play(self, tracks):
         """
@@ -489,13 +634,17 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         :param tracks: TrackList (used for tracking purposes)
         :return: None
         """
-        self.fill_track_listbox(tracks)
+        self.playing_tracks = tracks
+        if tracks is not self.listbox_tracks:
+            self.fill_track_listbox(tracks)
         if len(tracks) == 0:
             return
         track = tracks.current()
         self.change_fileinfo(track)
         self.update_idletasks()
         self.play_track(track, tracks)
+        if self.loop_job is not None:
+            self.after_cancel(self.loop_job)
         self.play_loop(tracks)
 
     def play_track(self, track, tracks, position=None):
@@ -512,23 +661,13 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         self.total_time['text'] = convert_milli_to_std(track['durationMillis'])
         self.update_listbox(tracks)
         self.update_idletasks()
-        if 'id' in track:
-            track_id = track['id']
-        elif 'storeId' in track:
-            track_id = track['storeId']
-        elif 'episodeId' in track:
-            track_id = track['episodeId']
-        else:
+        if library.get_track_id(track) is None:
             print 'Problem with track info...'
             print track
             self.play_track(tracks.next(), tracks)
             return
         try:
-            if 'episodeId' in track:
-                stream_audio_url = mobile_client.get_podcast_episode_stream_url(track_id, self.device_id)
-            else:
-                stream_audio_url = mobile_client.get_stream_url(track_id, self.device_id)
-            self.player.load_url(stream_audio_url)
+            self.player.load_url(self.get_play_url(track))
             self.player.play()
             if position:
                 print 'Setting Position...'
@@ -539,6 +678,7 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         except Exception, e:
             print("Error: " + str(e))
             print("Error retrieving track: " + track['title'])
+            self.stream_resolver.invalidate(track)
             self.play_track(tracks.next(), tracks)
             return
         max_millis = self.player.get_duration()
@@ -548,6 +688,7 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         self.player_state = "play"
         self.pause_state = "unpaused"
         self.enable_controls(True)
+        self.preload_next(tracks)
         current_search_index = self.search_choose.current()
         current_search = self.search_choose['values'][current_search_index]
         if current_search != "Playlists"\
@@ -556,39 +697,158 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
 
     def play_loop(self, tracks):
         """
-        Virtual loop that is called every LOOP_INTERVAL milliseconds for updating the time and position gui widgets.
+        Virtual loop for updating the time and position gui widgets and reacting to the player. Runs every
+        LOOP_INTERVAL to MAX_LOOP_INTERVAL milliseconds, depending on how soon the widgets will change.
         :param tracks: TrackList
         :return: None
         """
-        if self.listbox_tracks != tracks:
+        self.loop_job = None
+        if self.playing_tracks is not tracks:
             return  # This removes any stale loops that result from new searches
+        self.player.poll()
+        if self.player.has_given_up() and self.player_state == "play":
+            print 'Skipping track the player keeps failing on...'
+            self.enable_controls(False)
+            self.player.stop()
+            self.play_track(tracks.next(), tracks)
+            self.loop_job = self.after(LOOP_INTERVAL, self.play_loop, tracks)
+            return
         if not self.player.is_playing() \
                 and self.player_state == "play":
             print 'Problem with audio stream. Fixing...'
             self.enable_controls(False)
             self.play_track(tracks.current(), tracks, self.progress['value'])
-            self.after(LOOP_INTERVAL, self.play_loop, tracks)
+            self.loop_job = self.after(LOOP_INTERVAL, self.play_loop, tracks)
             return
         if self.player_state == "play":
-            self.after(LOOP_INTERVAL, self.play_loop, tracks)
+            self.queue_preloaded_url()
+            self.update_controls()
+            self.loop_job = self.after(self.get_loop_interval(), self.play_loop, tracks)
         elif self.player_state == "next":
             self.enable_controls(False)
             self.player.stop()
             self.play_track(tracks.next(), tracks)
-            self.after(LOOP_INTERVAL, self.play_loop, tracks)
-        self.update_controls()
+            self.loop_job = self.after(LOOP_INTERVAL, self.play_loop, tracks)
+            self.update_controls()
+
+    def wake_play_loop(self):
+        """
+        Runs the play loop as soon as Tk is idle instead of waiting for its next scheduled run.
+        :return: None
+        """
+        if self.loop_job is not None:
+            self.after_cancel(self.loop_job)
+            self.loop_job = self.after_idle(self.play_loop, self.playing_tracks)
+
+    def get_loop_interval(self):
+        """
+        Gets the delay until the play loop has something new to show, which is when the displayed time reaches its
+        next second.
+        :return: delay in milliseconds
+        """
+        if self.pause_state == "paused":
+            return MAX_LOOP_INTERVAL
+        interval = 1000 - int(self.progress['value']) % 1000
+        return max(LOOP_INTERVAL, min(MAX_LOOP_INTERVAL, interval))
 
     def update_controls(self):
         """
-        Updates the time and position gui widgets.
+        Updates the time and position gui widgets from the player position, showing the buffering progress instead of
+        the time while the player is buffering.
         :return: None
         """
-        if self.pause_state == "unpaused":
-            self.progress['value'] += LOOP_INTERVAL
-            pos = self.progress['value']
+        pos = self.player.get_position()
+        self.progress['value'] = pos
+        stats = self.player.get_buffering_stats()
+        if stats.get('underruns', 0) > self.underruns:
+            self.underruns = stats['underruns']
+            print 'Buffer underrun. Now buffering ' + str(stats['buffer_duration']) + ' ms'
+        if stats.get('percent', 100) < 100:
+            self.current_time['text'] = 'Buffering ' + str(stats['percent']) + '%'
+        else:
             self.current_time['text'] = convert_milli_to_std(pos)
-            if self.progress['value'] >= self.progress['maximum']:
-                self.player_state = "next"
+
+    def on_player_eos(self):
+        """
+        Callback function called when the player reaches the end of the track.
+        :return: None
+        """
+        if self.player_state == "play":
+            self.player_state = "next"
+
+    def get_stream_url(self, track, refresh=False):
+        """
+        Gets the audio stream url of the given track, from the stream url cache when possible.
+        :param track: track with an id, store id or podcast episode id
+        :param refresh: True to get a new url, as the cached one failed
+        :return: stream url
+        """
+        if refresh:
+            self.stream_resolver.invalidate(track)
+        return self.stream_resolver.get_stream_url(track, self.device_id)
+
+    def get_play_url(self, track):
+        """
+        Gets the url to play a track from. That is the audio cache if it has the track, and otherwise the buffer
+        server, which keeps what it downloaded when the track is played again or the player has to recover.
+        :param track: track with an id, store id or podcast episode id
+        :return: file uri or local http url
+        """
+        url = self.audio_cache.get_uri(track)
+        if url is None:
+            url = self.buffer_server.get_url_for(track)
+        return url
+
+    def preload_next(self, tracks):
+        """
+        Starts resolving the stream urls and loading the art of the next PRERESOLVE_COUNT tracks on worker threads, so
+        the player can continue with the next one without a gap and Next does not wait on Google Play Music.
+        :param tracks: TrackList
+        :return: None
+        """
+        self.preload = tracks.peek_next()
+        self.queued_url = None
+        upcoming = tracks.upcoming(PRERESOLVE_COUNT)
+        self.stream_resolver.prefetch(upcoming, self.device_id)
+        self.fetch_art([url for url in map(art.get_art_url, upcoming) if url is not None])
+
+    def queue_preloaded_url(self):
+        """
+        Hands the url of the next track to the player. The buffer server only asks for its stream url once the player
+        starts reading it, so it never expires while queued.
+        :return: None
+        """
+        if self.preload is None or self.queued_url is not None:
+            return
+        self.queued_url = self.get_play_url(self.preload)
+        self.player.queue_url(self.queued_url)
+
+    def on_duration_changed(self, duration):
+        """
+        Callback function called when the player learns the real duration of the track.
+        :param duration: duration in ms
+        :return: None
+        """
+        if duration > 0:
+            self.progress['maximum'] = duration
+            self.total_time['text'] = convert_milli_to_std(duration)
+
+    def on_track_changed(self, tracks):
+        """
+        Updates the gui widgets after the player moved on to the queued track by itself.
+        :param tracks: TrackList
+        :return: None
+        """
+        track = tracks.next()
+        self.change_fileinfo(track)
+        self.progress['maximum'] = track['durationMillis']
+        self.total_time['text'] = convert_milli_to_std(track['durationMillis'])
+        self.update_listbox(tracks)
+        max_millis = self.player.get_duration()
+        if max_millis > 0:
+            self.progress['maximum'] = max_millis
+            self.total_time['text'] = convert_milli_to_std(max_millis)
+        self.preload_next(tracks)
 
     def change_fileinfo(self, metadata):
         """
@@ -596,14 +856,14 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         :param metadata: dictionary containing all metadata about the track
         :return: None
         """
-        global next_image
-        if 'albumArtRef' in metadata:
-            next_image = self.get_photo_image_from_url(metadata['albumArtRef'][0]['url'])
-        elif 'artistArtRef' in metadata:
-            next_image = self.get_photo_image_from_url(metadata['artistArtRef'][0]['url'])
-        elif 'art' in metadata:
-            next_image = self.get_photo_image_from_url(metadata['art'][0]['url'])
-        else:
+        self.art_url = art.get_art_url(metadata)
+        next_image = None
+        if self.art_url is not None:
+            next_image = self.art_cache.get_cached(self.art_url)
+            if next_image is None:
+                # The default image stands in until the art is loaded
+                self.fetch_art([self.art_url])
+        if next_image is None:
             next_image = self.default_image
         if 'year' in metadata:
             year = str(metadata['year'])
@@ -613,29 +873,44 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
             genre = metadata['genre']
         else:
             genre = 'Unknown'
-        self.album_image.configure(image=next_image)
+        self.show_image(next_image)
         self.fileinfo['text'] = "Title: " + metadata['title'] + "\nArtist: " + metadata['artist']\
                                 + "\nAlbum: " + metadata['album'] + "\nGenre: " + genre + "\nYear: " + year
         self.progress['value'] = 0
         self.current_time['text'] = "0:00"
         self.total_time['text'] = "0:00"
 
-    def get_photo_image_from_url(self, url):
+    def fetch_art(self, urls):
         """
-        Gets an album or artist image from the given url.
-        :param url: URL of the album/artist image
-        :return: ImageTk PhotoImage representing the album/artist image
+        Starts loading art on the art cache's worker threads, and checking for it with after.
+        :param urls: art urls
+        :return: None
         """
-        try:
-            image_bytes = urlopen(url).read()
-            data_stream = io.BytesIO(image_bytes)
-        except Exception, e:
-            print("Error: " + str(e))
-            print("Error retrieving song image.")
-            print("URL: " + url)
-            return self.default_image
-        pil_image = Image.open(data_stream)
-        return ImageTk.PhotoImage(pil_image, master=self)
+        for url in urls:
+            self.art_cache.fetch(url)
+        if self.art_job is None and self.art_cache.pending:
+            self.art_job = self.after(ART_POLL_INTERVAL, self.check_art)
+
+    def check_art(self):
+        """
+        Shows the art of the current track once it is loaded, checking again every ART_POLL_INTERVAL ms while art is
+        still loading.
+        :return: None
+        """
+        self.art_job = None
+        if self.art_url in self.art_cache.poll():
+            self.show_image(self.art_cache.get_cached(self.art_url))
+        if self.art_cache.pending:
+            self.art_job = self.after(ART_POLL_INTERVAL, self.check_art)
+
+    def show_image(self, image):
+        """
+        Shows an album or artist image, keeping a reference to it so it stays valid after leaving the art cache.
+        :param image: ImageTk PhotoImage
+        :return: None
+        """
+        self.shown_image = image
+        self.album_image.configure(image=image)
 
     def enable_controls(self, enable):
         """
@@ -652,15 +927,32 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
 
     def fill_track_listbox(self, tracks):
         """
-        Fills the tracks listbox with track from tracks TrackList
+        Fills the tracks listbox with track from tracks TrackList. The first LISTBOX_CHUNK rows, which include
+        the visible ones, are inserted right away and the rest in the background.
         :param tracks: TrackList
         :return: None
         """
+        if self.listbox_fill_job is not None:
+            self.after_cancel(self.listbox_fill_job)
+            self.listbox_fill_job = None
         self.track_listbox.delete(0, Tkinter.END)
-        for track in tracks:
-            self.track_listbox.insert(Tkinter.END, track_listbox_template(track))
-
         self.listbox_tracks = tracks
+        self.fill_listbox_chunk(tracks, 0)
+
+    def fill_listbox_chunk(self, tracks, start):
+        """
+        Inserts the next LISTBOX_CHUNK rows of tracks into the track listbox.
+        :param tracks: TrackList being shown in the listbox
+        :param start: index of the first track to insert
+        :return: None
+        """
+        self.listbox_fill_job = None
+        end = start + LISTBOX_CHUNK
+        self.track_listbox.insert(Tkinter.END, *[track_listbox_template(track) for track in tracks[start:end]])
+        if end < len(tracks):
+            self.listbox_fill_job = self.after(1, self.fill_listbox_chunk, tracks, end)
+        elif tracks is self.playing_tracks and len(tracks) > LISTBOX_CHUNK:
+            self.update_listbox(tracks)
 
     def select_track(self, event):
         """
@@ -674,6 +966,10 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         self.player.stop()
         curselection = self.track_listbox.curselection()[0]
         tracks = self.listbox_tracks
+        if tracks is not self.playing_tracks:
+            tracks.at(int(curselection))
+            self.play(tracks)
+            return
         self.play_track(tracks.at(int(curselection)), tracks)
 
     def update_listbox(self, tracks):
@@ -682,6 +978,8 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         :param tracks: TrackList
         :return: None
         """
+        if tracks is not self.listbox_tracks:
+            return
         self.track_listbox.select_clear(0, Tkinter.END)
         self.track_listbox.select_set(tracks.pos)
         self.track_listbox.activate(tracks.pos)
@@ -731,13 +1029,11 @@ class MainWindow(shared.Centerable, Tkinter.Tk):
         :param playlist_dict_tracks: list of tracks from playlist dictionary
         :return: TrackList of playlist tracks
         """
-        id_list = [item['trackId'] for item in playlist_dict_tracks]
-        playlist_tracks = [track for track in self.library if track['id'] in id_list]
-        playlist_tracks.sort(key=lambda trk: id_list.index(trk['id']))
-        return TrackList(playlist_tracks)
+        return TrackList(library.resolve_playlist(self.library, playlist_dict_tracks))
 
     def on_track_download(self, track):
-        GMusicDownloader.download_track(track, path='', mobile_client=mobile_client, device_id=self.device_id)
+        downloader.download_track(track, path='', mobile_client=mobile_client, device_id=self.device_id,
+                                  audio_cache=self.audio_cache)
 
 
 '''class CenterableToplevel(Tkinter.Toplevel):
@@ -833,5 +1129,6 @@ if __name__ == "__main__":
             force_prompt = True
 
     app = MainWindow()
-    app.title('PyPlayMusic')
+    app.title(TITLE)
     app.mainloop()
+    sys.exit(app.exit_status)
@@ -0,0 +1,154 @@
+import hashlib
+import io
+import os
+import Queue
+import threading
+from collections import OrderedDict
+from urllib2 import urlopen
+
+from PIL import Image, ImageTk
+
+from workers import WorkerPool
+
+# Directory of the resized art kept between runs
+ART_CACHE_DIR = '.art_cache'
+# Largest width and height art is shown at
+ART_SIZE = 256
+# Number of decoded images kept in memory
+MAX_IMAGES = 32
+# Number of threads fetching and resizing art
+ART_WORKERS = 2
+
+
+def get_art_url(track):
+    """
+    Gets the url of the album, artist or podcast art of a track.
+    :param track: track dict
+    :return: url, or None if the track has no art
+    """
+    for key in ('albumArtRef', 'artistArtRef', 'art'):
+        if key in track:
+            return track[key][0]['url']
+    return None
+
+
+class ArtCache(object):
+    """
+    Album and artist art keyed by url, in two tiers: an LRU of decoded PhotoImages at display size in front of a
+    directory of resized thumbnails. Tracks sharing a cover cost no network or decode work after the first one.
+    Art that is not in memory is fetched and resized on worker threads, and turned into PhotoImages by poll on the
+    Tk thread.
+    """
+    def __init__(self, master, directory=ART_CACHE_DIR, size=ART_SIZE, max_images=MAX_IMAGES):
+        """
+        ArtCache __init__ function
+        :param master: Tk widget the PhotoImages belong to
+        :param directory: directory of the thumbnails
+        :param size: largest width and height of the thumbnails
+        :param max_images: number of PhotoImages kept in memory
+        :return: None
+        """
+        self.master = master
+        self.directory = directory
+        self.size = size
+        self.max_images = max_images
+        self.images = OrderedDict()
+        self.pending = set()
+        self.loaded = Queue.Queue()
+        self.pool = WorkerPool(ART_WORKERS)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest() + '.jpg')
+
+    def load_thumbnail(self, url):
+        """
+        Gets the resized art from the disk, downloading and resizing it first if it is not there. Does not touch Tk,
+        so it can run on any thread.
+        :param url: art url
+        :return: PIL Image, or None if the art could not be retrieved
+        """
+        path = self.get_path(url)
+        if os.path.exists(path):
+            try:
+                image = Image.open(path)
+                image.load()
+                return image
+            except IOError, e:
+                print("Error: " + str(e))
+                print("Error reading cached image: " + path)
+        try:
+            image = Image.open(io.BytesIO(urlopen(url).read()))
+            image.thumbnail((self.size, self.size), Image.ANTIALIAS)
+            image = image.convert('RGB')
+        except Exception, e:
+            print("Error: " + str(e))
+            print("Error retrieving song image.")
+            print("URL: " + url)
+            return None
+        temp_path = path + '.' + str(threading.current_thread().ident) + '.tmp'
+        try:
+            image.save(temp_path, 'JPEG', quality=90)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except (IOError, OSError), e:
+            print("Error: " + str(e))
+            print("Error caching image: " + path)
+        return image
+
+    def get_cached(self, url):
+        """
+        Gets a decoded image from memory, marking it as recently used.
+        :param url: art url
+        :return: PhotoImage, or None if it is not in memory
+        """
+        image = self.images.pop(url, None)
+        if image is not None:
+            self.images[url] = image
+        return image
+
+    def add(self, url, thumbnail):
+        """
+        Decodes a thumbnail into a PhotoImage kept in memory. Must be called from the Tk thread.
+        :param url: art url
+        :param thumbnail: PIL Image
+        :return: PhotoImage
+        """
+        image = ImageTk.PhotoImage(thumbnail, master=self.master)
+        self.images.pop(url, None)
+        self.images[url] = image
+        while len(self.images) > self.max_images:
+            self.images.popitem(last=False)
+        return image
+
+    def fetch(self, url):
+        """
+        Starts loading art into memory on a worker thread, unless it is there or on its way already.
+        :param url: art url
+        :return: None
+        """
+        if url in self.images or url in self.pending:
+            return
+        self.pending.add(url)
+        self.pool.submit(self.fetch_one, url)
+
+    def fetch_one(self, url):
+        self.loaded.put((url, self.load_thumbnail(url)))
+
+    def poll(self):
+        """
+        Adds the art the worker threads finished loading to memory. Must be called from the Tk thread.
+        :return: set of the urls that were added
+        """
+        added = set()
+        while True:
+            try:
+                url, thumbnail = self.loaded.get_nowait()
+            except Queue.Empty:
+                return added
+            self.pending.discard(url)
+            if thumbnail is not None:
+                self.add(url, thumbnail)
+                added.add(url)
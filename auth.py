@@ -2,53 +2,7 @@
 
 import tkFont
 import Tkinter
-from Crypto.Cipher import Blowfish
-from Crypto import Random
-from struct import pack, unpack
-
-KEY = b'4hdkljf01n3(ijl2hqsamn^wjl'
-CACHE_FILE = '.cache'
-
-
-def open_cached():
-    """
-    Opens cached credentials file.
-    :return: File object or None if file does not exist or cannot be opened
-    """
-    try:
-        cached = open(CACHE_FILE)
-    except IOError:
-        return None
-    return cached
-
-
-def encrypt(passwd):
-    """
-    Encrypts the given string.
-    :param passwd: password string
-    :return: encrypted string representation of given passwd
-    """
-    bs = Blowfish.block_size
-    iv = Random.new().read(bs)
-    cipher = Blowfish.new(KEY, Blowfish.MODE_CBC, iv)
-    plen = bs - len(passwd) % bs
-    padding = [plen]*plen
-    padding = pack('b'*plen, *padding)
-    return iv + cipher.encrypt(passwd + padding)
-
-
-def decrypt(ciphered_pw):
-    """
-    Decrypts the given encrypted string.
-    :param ciphered_pw: string to be decrypted
-    :return: unencrypted string
-    """
-    bs = Blowfish.block_size
-    iv = Random.new().read(bs)
-    cipher = Blowfish.new(KEY, Blowfish.MODE_CBC, iv)
-    padded_decrypt = cipher.decrypt(ciphered_pw)
-    padding_len = unpack('b', padded_decrypt[-1:])[0]
-    return padded_decrypt[len(iv):len(ciphered_pw) - padding_len]
+from credentials import load_cached_credentials, save_credentials
 
 
 class AuthHandler(object):
@@ -66,10 +20,9 @@ class AuthHandler(object):
         self.uname = None
         self.passwd = None
         self.canceled = False
-        cached = open_cached()
+        cached = load_cached_credentials()
         if cached and not force_prompt:
-            self.uname = cached.readline().rstrip()
-            self.passwd = decrypt(cached.read())
+            self.uname, self.passwd = cached
         else:
             auth_win = AuthWindow(None, title, above_this)
             # auth_win.mainloop()
@@ -164,8 +117,7 @@ class AuthWindow(Tkinter.Tk):
         self.canceled = False
         self.uname = self.u_field_variable.get()
         self.passwd = self.p_field_variable.get()
-        cached = open(CACHE_FILE, 'w')
-        cached.write(self.uname + '\n' + encrypt(self.passwd))
+        save_credentials(self.uname, self.passwd)
         if self.above_this:
             self.above_this.deiconify()
         self.destroy()
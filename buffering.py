@@ -0,0 +1,385 @@
+import BaseHTTPServer
+import os
+import re
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+from collections import OrderedDict
+
+import library
+from streaming import CHUNK_SIZE
+
+# Number of stream buffers kept open, so the previous, current and next tracks can be served again
+MAX_BUFFERS = 3
+# Attempts at resuming a download in a row before giving up on it, and seconds between them
+MAX_RETRIES = 5
+RETRY_DELAY = 1
+# Seconds a read from Google Play Music may take before the download is resumed
+READ_TIMEOUT = 30
+# Bytes ahead of the download position a read waits for instead of moving the download
+SEEK_AHEAD = 256 * 1024
+RANGE_PATTERN = re.compile(r'bytes=(\d+)-')
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-\d+/(\d+)')
+
+
+class StreamBuffer(object):
+    """
+    Downloads the audio of a track into a sparse file, keeping track of the byte ranges received. A read outside of
+    them that the download will not reach soon moves the download there, and once the end is reached the gaps left
+    behind are filled in. Failed connections are resumed with a range request from the last byte received, so no
+    byte is ever downloaded twice.
+    """
+    def __init__(self, track, get_url, path):
+        """
+        StreamBuffer __init__ function
+        :param track: track with an id, store id or podcast episode id
+        :param get_url: function taking the track and whether the last url failed, returning a stream url
+        :param path: file to buffer to
+        :return: None
+        """
+        self.track = track
+        self.get_url = get_url
+        self.path = path
+        self.length = None
+        self.ranges = []
+        self.position = 0
+        self.target = None
+        self.complete = False
+        self.closed = False
+        self.error = None
+        self.thread = None
+        self.condition = threading.Condition()
+
+    def get_range_end(self, offset):
+        """
+        Gets the end of the received bytes from offset on. Expects the condition to be held.
+        :param offset: position in the track
+        :return: end of the received range holding offset, or offset if that byte was not received
+        """
+        for start, end in self.ranges:
+            if start <= offset < end:
+                return end
+        return offset
+
+    def get_missing(self, offset):
+        """
+        Gets the first byte not received from offset on, going back to the start of the track if everything after
+        offset was received. Expects the condition to be held.
+        :param offset: position in the track
+        :return: position in the track, or None if the whole track was received
+        """
+        offset = self.get_range_end(offset)
+        if self.length is None or offset < self.length:
+            return offset
+        offset = self.get_range_end(0)
+        if offset < self.length:
+            return offset
+        return None
+
+    def add_range(self, start, end):
+        """
+        Records received bytes, merging touching ranges. Expects the condition to be held.
+        :param start: position of the first byte
+        :param end: position after the last byte
+        :return: None
+        """
+        ranges = []
+        for range_start, range_end in self.ranges:
+            if range_end < start or range_start > end:
+                ranges.append((range_start, range_end))
+            else:
+                start, end = min(start, range_start), max(end, range_end)
+        ranges.append((start, end))
+        ranges.sort()
+        self.ranges = ranges
+        if self.length is not None and self.ranges[0] == (0, self.length):
+            self.complete = True
+
+    def start(self):
+        """
+        Starts or resumes the download on its own thread, unless it is already running.
+        :return: None
+        """
+        with self.condition:
+            if self.complete or self.closed or (self.thread is not None and self.thread.is_alive()):
+                return
+            self.error = None
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        failures = 0
+        mode = 'r+b' if os.path.exists(self.path) else 'wb'
+        with open(self.path, mode) as buffer_file:
+            while not self.closed and not self.complete:
+                try:
+                    if not self.download(buffer_file, failures > 0):
+                        # Retrying at once would spin, so no progress counts as a failure
+                        raise IOError('No bytes received at byte %d' % self.position)
+                    failures = 0
+                except Exception, e:
+                    failures += 1
+                    print("Error: " + str(e))
+                    if failures > MAX_RETRIES:
+                        print("Error buffering track: " + self.track['title'])
+                        with self.condition:
+                            self.error = e
+                            self.condition.notify_all()
+                        return
+                    time.sleep(RETRY_DELAY)
+
+    def download(self, buffer_file, refresh):
+        """
+        Fetches bytes from the first one missing at the download position, until reaching bytes already received,
+        the end of the track, or a read asking for another position.
+        :param buffer_file: open buffer file
+        :param refresh: True to get a new stream url, as the last one failed
+        :return: True if any bytes were received
+        """
+        with self.condition:
+            if self.target is not None:
+                self.position = self.target
+                self.target = None
+            offset = self.get_missing(self.position)
+            if offset is None:
+                return False
+        request = urllib2.Request(self.get_url(self.track, refresh))
+        if offset > 0:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        response = urllib2.urlopen(request, timeout=READ_TIMEOUT)
+        content_range = CONTENT_RANGE_PATTERN.match(response.info().getheader('Content-Range', ''))
+        if content_range is not None:
+            start, length = int(content_range.group(1)), int(content_range.group(2))
+        else:
+            start, length = 0, response.info().getheader('Content-Length')
+            length = int(length) if length is not None else None
+        if start != offset:
+            # The server ignored the range, so skip the bytes before it
+            remaining = offset - start
+            while remaining > 0:
+                skipped = len(response.read(min(remaining, CHUNK_SIZE)))
+                if skipped == 0:
+                    raise IOError('Stream ended before byte %d' % offset)
+                remaining -= skipped
+        with self.condition:
+            if length is not None:
+                self.length = length
+            self.condition.notify_all()
+            # Bytes after this were received already, so the download stops there
+            stop = min([range_start for range_start, range_end in self.ranges if range_start > offset] or
+                       [self.length])
+        received = False
+        while not self.closed:
+            size = CHUNK_SIZE if stop is None else min(CHUNK_SIZE, stop - offset)
+            chunk = response.read(size) if size > 0 else ''
+            if not chunk:
+                break
+            buffer_file.seek(offset)
+            buffer_file.write(chunk)
+            buffer_file.flush()
+            received = True
+            with self.condition:
+                self.add_range(offset, offset + len(chunk))
+                offset += len(chunk)
+                self.position = offset
+                self.condition.notify_all()
+                if self.target is not None:
+                    return True
+        with self.condition:
+            if self.closed:
+                return received
+            if self.length is None:
+                self.length = offset
+                self.add_range(offset, offset)
+                self.condition.notify_all()
+            elif offset < (stop if stop is not None else self.length):
+                raise IOError('Stream ended at byte %d of %d' % (offset, self.length))
+        return received
+
+    def wait_for_length(self):
+        """
+        Waits until the length of the track is known.
+        :return: length in bytes, or None if the download failed first
+        """
+        with self.condition:
+            while self.length is None and self.error is None and not self.closed:
+                self.condition.wait()
+            return self.length
+
+    def read(self, offset, size):
+        """
+        Reads received bytes. If the byte at offset has not been received, the download is moved there unless it
+        is about to reach it, and the read waits for it.
+        :param offset: position in the track
+        :param size: maximum number of bytes
+        :return: bytes, or an empty string at the end of the track or if the download failed
+        """
+        with self.condition:
+            end = self.get_range_end(offset)
+            if end == offset and not (self.position <= offset < self.position + SEEK_AHEAD):
+                self.target = offset
+            while end == offset and not self.complete and self.error is None and not self.closed:
+                self.condition.wait()
+                end = self.get_range_end(offset)
+            available = min(size, end - offset)
+        if available <= 0:
+            return ''
+        with open(self.path, 'rb') as buffer_file:
+            buffer_file.seek(offset)
+            return buffer_file.read(available)
+
+    def close(self):
+        """
+        Stops the download and wakes up any readers.
+        :return: None
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class BufferRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves a buffered track to the player, honouring the range requests it makes to seek. Ranges that were not
+    received yet are fetched on demand by the StreamBuffer.
+    """
+    def do_GET(self):
+        stream_buffer = self.server.buffer_server.get_buffer(self.path.lstrip('/'))
+        if stream_buffer is None:
+            self.send_error(404)
+            return
+        stream_buffer.start()
+        length = stream_buffer.wait_for_length()
+        if length is None:
+            self.send_error(502)
+            return
+        match = RANGE_PATTERN.match(self.headers.getheader('Range', ''))
+        start = int(match.group(1)) if match is not None else 0
+        if start >= length > 0:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % length)
+            self.end_headers()
+            return
+        if match is not None:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, length - 1, length))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(length - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        offset = start
+        try:
+            while offset < length:
+                chunk = stream_buffer.read(offset, CHUNK_SIZE)
+                if not chunk:
+                    return
+                self.wfile.write(chunk)
+                offset += len(chunk)
+        except socket.error:
+            pass  # The player closed the connection, as it does when seeking or stopping
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The player closing a connection is not an error
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class BufferServer(object):
+    """
+    Local http server the player streams from, so that the downloads of the last MAX_BUFFERS tracks outlive the
+    player's connections. Replaying or recovering a track then starts from the bytes already buffered, and
+    finished downloads are moved into the audio cache.
+    """
+    def __init__(self, audio_cache, get_url):
+        """
+        BufferServer __init__ function
+        :param audio_cache: streaming.AudioCache to buffer in and move finished tracks to
+        :param get_url: function taking a track and whether its last url failed, returning a stream url
+        :return: None
+        """
+        self.audio_cache = audio_cache
+        self.get_url = get_url
+        self.buffers = OrderedDict()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BufferRequestHandler)
+        self.server.buffer_server = self
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def get_buffer(self, track_id):
+        with self.lock:
+            return self.buffers.get(track_id)
+
+    def get_url_for(self, track):
+        """
+        Gets the local url of a track, keeping what was already buffered for it. The download only starts once the
+        player asks for the url.
+        :param track: track with an id, store id or podcast episode id
+        :return: local http url
+        """
+        track_id = library.get_track_id(track)
+        closing = []
+        with self.lock:
+            stream_buffer = self.buffers.pop(track_id, None)
+            if stream_buffer is None or stream_buffer.closed:
+                # A file of its own, as a closed buffer of the same track may still be releasing its file
+                buffer_file, path = tempfile.mkstemp(prefix=track_id + '.', suffix='.buffer',
+                                                     dir=self.audio_cache.directory)
+                os.close(buffer_file)
+                stream_buffer = StreamBuffer(track, self.get_url, path)
+            self.buffers[track_id] = stream_buffer
+            while len(self.buffers) > MAX_BUFFERS:
+                closing.append(self.buffers.popitem(last=False)[1])
+        for old_buffer in closing:
+            # Waiting for a download to stop can take as long as a read from the network, so not on this thread
+            release_thread = threading.Thread(target=self.release, args=(old_buffer,))
+            release_thread.daemon = True
+            release_thread.start()
+        return 'http://127.0.0.1:%d/%s' % (self.server.server_address[1], track_id)
+
+    def release(self, stream_buffer):
+        """
+        Closes a buffer, moving the track into the audio cache if it was downloaded completely.
+        :param stream_buffer: StreamBuffer
+        :return: None
+        """
+        stream_buffer.close()
+        if stream_buffer.thread is not None:
+            stream_buffer.thread.join()
+        try:
+            if stream_buffer.complete:
+                self.audio_cache.store_file(stream_buffer.track, stream_buffer.path)
+            elif os.path.exists(stream_buffer.path):
+                os.remove(stream_buffer.path)
+        except OSError, e:
+            print("Error: " + str(e))
+
+    def shutdown(self):
+        """
+        Stops the server, moving the tracks that were downloaded completely into the audio cache. Partial buffers
+        are left for the audio cache to clean up.
+        :return: None
+        """
+        self.server.shutdown()
+        with self.lock:
+            buffers = self.buffers.values()
+            self.buffers.clear()
+        for stream_buffer in buffers:
+            stream_buffer.close()
+            if stream_buffer.complete:
+                self.release(stream_buffer)
@@ -0,0 +1,75 @@
+"""
+Cached Google credentials, kept apart from the Tk login window so programs without a display can use them.
+"""
+from Crypto.Cipher import Blowfish
+from Crypto import Random
+from struct import pack, unpack
+
+KEY = b'4hdkljf01n3(ijl2hqsamn^wjl'
+CACHE_FILE = '.cache'
+
+
+def open_cached():
+    """
+    Opens cached credentials file.
+    :return: File object or None if file does not exist or cannot be opened
+    """
+    try:
+        cached = open(CACHE_FILE)
+    except IOError:
+        return None
+    return cached
+
+
+def encrypt(passwd):
+    """
+    Encrypts the given string.
+    :param passwd: password string
+    :return: encrypted string representation of given passwd
+    """
+    bs = Blowfish.block_size
+    iv = Random.new().read(bs)
+    cipher = Blowfish.new(KEY, Blowfish.MODE_CBC, iv)
+    plen = bs - len(passwd) % bs
+    padding = [plen]*plen
+    padding = pack('b'*plen, *padding)
+    return iv + cipher.encrypt(passwd + padding)
+
+
+def decrypt(ciphered_pw):
+    """
+    Decrypts the given encrypted string.
+    :param ciphered_pw: string to be decrypted
+    :return: unencrypted string
+    """
+    bs = Blowfish.block_size
+    iv = Random.new().read(bs)
+    cipher = Blowfish.new(KEY, Blowfish.MODE_CBC, iv)
+    padded_decrypt = cipher.decrypt(ciphered_pw)
+    padding_len = unpack('b', padded_decrypt[-1:])[0]
+    return padded_decrypt[len(iv):len(ciphered_pw) - padding_len]
+
+
+def load_cached_credentials():
+    """
+    Reads the cached credentials.
+    :return: tuple of username and password, or None if there are no cached credentials
+    """
+    cached = open_cached()
+    if cached is None:
+        return None
+    with cached:
+        uname = cached.readline().rstrip()
+        passwd = decrypt(cached.read())
+    return uname, passwd
+
+
+def save_credentials(uname, passwd):
+    """
+    Caches credentials, encrypting the password.
+    :param uname: username
+    :param passwd: password
+    :return: None
+    """
+    with open(CACHE_FILE, 'w') as cached:
+        cached.write(uname + '\n' + encrypt(passwd))
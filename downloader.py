@@ -0,0 +1,612 @@
+import hashlib
+import io
+import json
+import os
+import Queue
+import tempfile
+import threading
+import urlparse
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime as dt
+from urllib2 import HTTPError, Request, urlopen
+
+from eyed3.id3 import Tag
+from eyed3.id3.frames import ImageFrame
+
+import library
+from workers import Task, WorkerPool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # Covers are embedded as served
+
+# Number of tracks downloaded at the same time, and connections allowed to any one host
+DOWNLOAD_WORKERS = 4
+MAX_PER_HOST = 2
+# Number of threads building ID3 tags while the audio downloads
+TAG_WORKERS = 2
+# Bytes read from a stream at a time
+CHUNK_SIZE = 64 * 1024
+# Name of the file in a destination directory recording the tracks downloaded to it
+MANIFEST_FILE = '.gmusic_manifest'
+# Largest width and height of the covers embedded in downloaded tracks, or None to embed them as served, and the
+# JPEG quality of the covers that are made smaller
+COVER_SIZE = 600
+COVER_QUALITY = 90
+
+
+class HostLimiter(object):
+    """
+    Caps the number of connections open to each host at the same time.
+    """
+    def __init__(self, max_per_host=MAX_PER_HOST):
+        """
+        HostLimiter __init__ function
+        :param max_per_host: connections allowed per host, or None for no limit
+        :return: None
+        """
+        self.max_per_host = max_per_host
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def limit(self, url):
+        """
+        Context manager waiting for a free connection slot for the host of url, holding it until the block ends.
+        :param url: url about to be fetched
+        """
+        if self.max_per_host is None:
+            yield
+            return
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.get(host)
+            if semaphore is None:
+                semaphore = self.semaphores[host] = threading.Semaphore(self.max_per_host)
+        with semaphore:
+            yield
+
+
+UNLIMITED = HostLimiter(None)
+
+
+class Manifest(object):
+    """
+    Record of the tracks downloaded to a destination directory: the path, size and md5 of the file written for each
+    track id. Entries are appended to MANIFEST_FILE as json lines, the last one for a track winning, so recording a track
+    stays cheap however big the library is and an interrupted run loses nothing.
+    """
+    def __init__(self, directory):
+        """
+        Manifest __init__ function
+        :param directory: destination directory
+        :return: None
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_FILE)
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as manifest_file:
+                for line in manifest_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Cut off by an interrupted run
+                    self.entries[entry['id']] = entry
+
+    def is_complete(self, track_id, path):
+        """
+        Checks whether a track was downloaded to path and the file still has the size and md5 it was written with.
+        Entries recorded without an md5 are checked by size alone.
+        :param track_id: track id
+        :param path: path the track would be downloaded to
+        :return: True if the track does not need to be downloaded again
+        """
+        with self.lock:
+            entry = self.entries.get(track_id)
+        if entry is None or entry['path'] != os.path.relpath(path, self.directory):
+            return False
+        try:
+            if os.path.getsize(path) != entry['size']:
+                return False
+            # Hashed only once the size matches, so a file that changed size is never read
+            return 'md5' not in entry or hash_file(path).hexdigest() == entry['md5']
+        except (IOError, OSError):
+            return False
+
+    def record(self, track_id, path, md5=None):
+        """
+        Records a track whose file was written completely.
+        :param track_id: track id
+        :param path: path of the file
+        :param md5: hex md5 of the file, as returned by write_stream
+        :return: None
+        """
+        entry = {
+            'id': track_id,
+            'path': os.path.relpath(path, self.directory),
+            'size': os.path.getsize(path),
+        }
+        if md5 is not None:
+            entry['md5'] = md5
+        with self.lock:
+            self.entries[track_id] = entry
+            with open(self.path, 'a') as manifest_file:
+                manifest_file.write(json.dumps(entry) + '\n')
+
+
+class DownloadEngine(object):
+    """
+    Runs download jobs on a bounded pool of threads, with a separate pool building tags while the audio is fetched.
+    Every job reports on the progress queue when it starts, as ('started', label), and when it ends, as
+    ('finished', label, succeeded), so a window can follow along by polling the queue from the Tk thread.
+    """
+    def __init__(self, workers=DOWNLOAD_WORKERS, max_per_host=MAX_PER_HOST):
+        """
+        DownloadEngine __init__ function
+        :param workers: number of jobs run at the same time
+        :param max_per_host: connections allowed per host across all jobs
+        :return: None
+        """
+        self.pool = WorkerPool(workers)
+        self.tag_pool = WorkerPool(TAG_WORKERS)
+        self.host_limiter = HostLimiter(max_per_host)
+        self.progress = Queue.Queue()
+        self.total = 0
+
+    def submit(self, label, download, *args, **kwargs):
+        """
+        Queues a download job. The job gets the engine's HostLimiter and tagging WorkerPool as its host_limiter and
+        tag_pool keyword arguments.
+        :param label: text describing the job in progress reports
+        :param download: function doing the download, returning False if it failed
+        :param args: positional arguments for download
+        :param kwargs: keyword arguments for download
+        :return: None
+        """
+        self.total += 1
+        kwargs['host_limiter'] = self.host_limiter
+        kwargs['tag_pool'] = self.tag_pool
+        self.pool.submit(self.run_job, label, download, args, kwargs)
+
+    def run_job(self, label, download, args, kwargs):
+        self.progress.put(('started', label))
+        try:
+            succeeded = download(*args, **kwargs) is not False
+        except Exception, e:
+            print("Error: " + str(e))
+            print("Error downloading: " + label)
+            succeeded = False
+        self.progress.put(('finished', label, succeeded))
+
+    def shutdown(self):
+        """
+        Stops the threads once the queued jobs have run.
+        :return: None
+        """
+        self.pool.shutdown()
+        self.tag_pool.shutdown()
+
+
+class CoverCache(object):
+    """
+    Covers fetched during one download run, keyed by url, so the tracks of an album share one download of their
+    cover. Covers larger than max_size are resized and recompressed once, before any track embeds them.
+    """
+    def __init__(self, max_size=COVER_SIZE):
+        """
+        CoverCache __init__ function
+        :param max_size: largest width and height of the embedded covers, or None to keep them as served
+        :return: None
+        """
+        self.max_size = max_size
+        self.covers = {}
+        self.lock = threading.Lock()
+
+    def get(self, url, host_limiter=UNLIMITED):
+        """
+        Gets a cover, fetching it unless it was fetched already or another thread is fetching it. Safe to call from
+        several threads at once. A cover that could not be fetched is not tried again during the run.
+        :param url: art url
+        :param host_limiter: HostLimiter capping the connections to the image host
+        :return: tuple containing mime-type and image data, or None if the cover could not be fetched
+        """
+        with self.lock:
+            task = self.covers.get(url)
+            fetching = task is None
+            if fetching:
+                task = self.covers[url] = Task(self.fetch, (url, host_limiter), {})
+        if fetching:
+            task.run()
+        return task.result()
+
+    def fetch(self, url, host_limiter):
+        try:
+            mime_type, image_bytes = get_image_tuple_from_url(url, host_limiter)
+        except Exception, e:
+            print("Error: " + str(e))
+            print("Error retrieving cover: " + url)
+            return None
+        if self.max_size is None or Image is None:
+            return mime_type, image_bytes
+        try:
+            image = Image.open(io.BytesIO(image_bytes))
+            if max(image.size) <= self.max_size:
+                return mime_type, image_bytes
+            image.thumbnail((self.max_size, self.max_size), Image.ANTIALIAS)
+            resized = io.BytesIO()
+            image.convert('RGB').save(resized, 'JPEG', quality=COVER_QUALITY)
+        except IOError, e:
+            print("Error: " + str(e))
+            print("Error resizing cover: " + url)
+            return mime_type, image_bytes
+        return 'image/jpeg', resized.getvalue()
+
+
+def folder_name(name):
+    """
+    Makes a directory name out of an artist, album, playlist or podcast name.
+    :param name: name
+    :return: name without the characters that cannot be used in a path
+    """
+    return name.replace('/', '_').replace('=', '_')
+
+
+class DownloadPlan(object):
+    """
+    Files to download, each with the track it holds, worked out before anything is fetched. A track added more than
+    once keeps the file it was first added with, and a track resolving to a file already planned for another track,
+    like an uploaded and a store copy of the same song, is skipped. Overlapping selections then download each file
+    once, no two jobs write the same file, and the number of jobs is the real amount of work.
+    """
+    def __init__(self, base_dir):
+        """
+        DownloadPlan __init__ function
+        :param base_dir: destination directory
+        :return: None
+        """
+        self.base_dir = base_dir
+        self.jobs = OrderedDict()
+        self.track_ids = set()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self, track, *folders):
+        """
+        Adds a track unless it or its file is in the plan already.
+        :param track: track dict or TrackRef
+        :param folders: names of the directories under base_dir to download it to
+        :return: True if the track was added
+        """
+        track_id = library.get_track_id(track)
+        if track_id is None or track_id in self.track_ids:
+            return False
+        directory = os.path.join(self.base_dir, *[folder_name(folder) for folder in folders])
+        path = os.path.join(directory, filename_template(track))
+        if path in self.jobs:
+            return False
+        self.jobs[path] = track
+        self.track_ids.add(track_id)
+        return True
+
+    def get_track(self, path):
+        return self.jobs[path]
+
+    def submit(self, engine, **kwargs):
+        """
+        Creates the directories of the plan and queues a download_track job for every file on an engine. Jobs are
+        labelled with the path of the file.
+        :param engine: DownloadEngine
+        :param kwargs: keyword arguments for download_track, like mobile_client, device_id and manifest
+        :return: None
+        """
+        for path, track in self.jobs.iteritems():
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            engine.submit(path, download_track, track, directory, **kwargs)
+
+
+def write_stream(stream, part_path, resume=False, header=''):
+    """
+    Copies a stream to a file in CHUNK_SIZE pieces, so memory use does not grow with the size of the track, and
+    flushes it to the disk. The file is hashed as it is written, so it never has to be read back.
+    :param stream: file-like object, or http response whose Content-Length is checked
+    :param part_path: path of the temporary file
+    :param resume: True to append to the file, when the stream continues where it ends
+    :param header: bytes written before the stream, unless resuming
+    :return: hex md5 of the whole file
+    """
+    expected = None
+    if hasattr(stream, 'info'):
+        expected = stream.info().getheader('Content-Length')
+    # The bytes already in the file are hashed once, before the rest is appended
+    checksum = hash_file(part_path) if resume else hashlib.md5()
+    size = 0
+    with open(part_path, 'ab' if resume else 'wb') as part_file:
+        if not resume:
+            part_file.write(header)
+            checksum.update(header)
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            part_file.write(chunk)
+            checksum.update(chunk)
+            size += len(chunk)
+        part_file.flush()
+        os.fsync(part_file.fileno())
+    if expected is not None and size != int(expected):
+        raise IOError('Stream ended after ' + str(size) + ' of ' + expected + ' bytes')
+    return checksum.hexdigest()
+
+
+def hash_file(path):
+    """
+    Hashes a file in CHUNK_SIZE pieces.
+    :param path: file path
+    :return: hashlib md5 object, which more bytes can be added to
+    """
+    checksum = hashlib.md5()
+    with open(path, 'rb') as hashed_file:
+        while True:
+            chunk = hashed_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    return checksum
+
+
+def get_range_total(error):
+    """
+    Gets the full size of a resource from the Content-Range header of a 416 response, sent as 'bytes */<size>'.
+    :param error: urllib2 HTTPError
+    :return: size in bytes, or None if the response does not give it
+    """
+    headers = error.info()
+    content_range = headers.getheader('Content-Range') if headers is not None else None
+    if content_range is None or '/' not in content_range:
+        return None
+    try:
+        return int(content_range.rsplit('/', 1)[1])
+    except ValueError:
+        return None
+
+
+def get_tag_size(path):
+    """
+    Gets the size of the ID3v2 tag a file starts with.
+    :param path: file path
+    :return: size in bytes, or 0 if the file does not start with a tag
+    """
+    with open(path, 'rb') as tagged_file:
+        header = tagged_file.read(10)
+    if len(header) < 10 or header[:3] != 'ID3':
+        return 0
+    # The size does not count the header or footer, and is stored as four bytes of seven bits
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (ord(byte) & 0x7f)
+    if ord(header[5]) & 0x10:
+        size += 10
+    return size + 10
+
+
+def replace_file(part_path, path):
+    """
+    Renames a finished temporary file, already flushed by write_stream, to its final name, so that name never holds
+    a partial file. On POSIX the directory is flushed too, so the rename itself survives a crash.
+    :param part_path: path of the temporary file
+    :param path: final path
+    :return: None
+    """
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(part_path, path)
+    if os.name == 'posix':
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+def remove_file(path):
+    """
+    Removes a file if it exists.
+    :param path: file path
+    :return: None
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def filename_template(track):
+    """
+    Formats template for naming a downloaded file
+    :param track: dict containing track info
+    :return: filename string
+    """
+    if 'trackNumber' in track:
+        date_or_tracknumber = str(track['trackNumber'])
+    else:
+        date_or_tracknumber = dt.fromtimestamp(int(track['publicationTimestampMillis'])/1000).strftime('%Y_%m_%d')
+    track_title = track['title'].replace('/', '_').replace('=', '_')
+    track_album = track['album'].replace('/', '_').replace('=', '_')
+    track_artist = track['artist'].replace('/', '_').replace('=', '_')
+    #return str(track['trackNumber']) + "-" + track_title + "-" + track_album + "-" + track_artist + ".mp3"
+    return date_or_tracknumber + "-" + track_title + "-" + track_album + "-" + track_artist + ".mp3"
+
+
+def get_image_tuple_from_url(url, host_limiter=UNLIMITED):
+    """
+    Gets an album or artist image from the given url.
+    :param url: URL of the album/artist image
+    :param host_limiter: HostLimiter capping the connections to the image host
+    :return: tuple containing mime-type and image data
+    """
+    with host_limiter.limit(url):
+        response = urlopen(url)
+        mime_type = response.info().type
+        image_bytes = response.read()
+    return mime_type, image_bytes
+
+
+def download_track(track, path='', mobile_client=None, device_id=None, audio_cache=None,
+                   host_limiter=UNLIMITED, manifest=None, covers=None, tag_pool=None):
+    """
+    Downloads the mp3 file of the given track. Safe to run on several threads at once.
+    :param track: Track dict
+    :param path: Path to download to. If omitted, then will download to current working directory.
+    :param audio_cache: streaming.AudioCache to take the audio from instead, if it has the track
+    :param host_limiter: HostLimiter capping the connections to the stream and image hosts
+    :param manifest: Manifest of the destination, to skip tracks it has complete, resume partial ones
+        and record the ones downloaded
+    :param covers: CoverCache of the download run, or None to fetch the cover for this track alone
+    :param tag_pool: WorkerPool to build the tag on while the audio is fetched, or None to build it on this thread
+    :return: True if the track was downloaded or skipped
+    """
+    if 'id' in track:
+        track_id = track['id']
+    elif 'storeId' in track:
+        track_id = track['storeId']
+    elif 'episodeId' in track:
+        track_id = track['episodeId']
+    else:
+        print 'Problem with track info...'
+        print track
+        return False
+    output_path = os.path.join(path, filename_template(track))
+    if manifest is not None and manifest.is_complete(track_id, output_path):
+        return True
+    # Written under a temporary name, so an interrupted download never leaves a truncated file under the final one
+    part_path = output_path + '.part'
+    if tag_pool is not None:
+        tag_task = tag_pool.submit(build_tag, track, host_limiter, covers)
+    else:
+        tag_task = Task(build_tag, (track, host_limiter, covers), {})
+        tag_task.run()
+    cached_file = None
+    if audio_cache is not None:
+        cached_file = audio_cache.open(track)
+    try:
+        #stream_url = mobile_client.get_stream_url(track_id, device_id)
+        if cached_file is not None:
+            with cached_file:
+                md5 = write_stream(cached_file, part_path, header=tag_task.result())
+        else:
+            if 'episodeId' in track:
+                stream_url = mobile_client.get_podcast_episode_stream_url(track_id, device_id)
+            else:
+                stream_url = mobile_client.get_stream_url(track_id, device_id)
+            request = Request(stream_url)
+            offset = 0
+            if manifest is not None and os.path.exists(part_path):
+                # Left by an interrupted run, tag first, so only the rest of the audio is fetched
+                tag_size = get_tag_size(part_path)
+                if tag_size > 0:
+                    offset = max(os.path.getsize(part_path) - tag_size, 0)
+                if offset > 0:
+                    request.add_header('Range', 'bytes=' + str(offset) + '-')
+            # Waited for before taking a connection slot, so a slow cover never holds one with the stream unread
+            header = tag_task.result()
+            with host_limiter.limit(stream_url):
+                try:
+                    response = urlopen(request)
+                except HTTPError, e:
+                    total = get_range_total(e)
+                    if e.code != 416 or offset == 0 or total is None or offset < total:
+                        raise
+                    # The part file already has all of the audio, left by a run interrupted before the rename
+                    response = None
+                if response is None:
+                    md5 = hash_file(part_path).hexdigest()
+                else:
+                    resume = offset > 0 and response.getcode() == 206
+                    md5 = write_stream(response, part_path, resume, '' if resume else header)
+    except Exception, e:
+        print "Error retrieving track: " + track['title']
+        print "Error: ", e
+        if manifest is None or (isinstance(e, HTTPError) and e.code == 416):
+            remove_file(part_path)
+        return False
+
+    try:
+        replace_file(part_path, output_path)
+    except Exception:
+        remove_file(part_path)
+        raise
+    if manifest is not None:
+        manifest.record(track_id, output_path, md5)
+    return True
+
+
+def build_tag(track, host_limiter=UNLIMITED, covers=None):
+    """
+    Builds the ID3 tag of a track in memory, so it can be written to the file ahead of the audio instead of eyed3
+    rewriting the whole file to insert it. Safe to run on several threads at once.
+    :param track: Track dict
+    :param host_limiter: HostLimiter capping the connections to the image host
+    :param covers: CoverCache to take the cover from, or None to fetch it
+    :return: bytes of the tag
+    """
+    tag = Tag()
+    tag.title = track['title']
+    tag.artist = track['artist']
+    tag.album = track['album']
+    tag.album_artist = track['albumArtist']
+    if 'genre' in track:
+        genre = track['genre']
+    else:
+        genre = u'Podcast'
+    tag.genre = genre
+    if 'year' in track:
+        year_int = int(track['year'])
+    else:
+        year_int = 0
+    if year_int != 0:
+        tag.release_date = year_int
+        tag.original_release_date = year_int
+        tag.recording_date = year_int
+    if 'trackNumber' in track:
+        track_number = track['trackNumber']
+    else:
+        track_number = 0
+    tag.track_num = track_number
+    if 'discNumber' in track:
+        disc_number = track['discNumber']
+    else:
+        disc_number = 1
+    tag.disc_num = disc_number
+    for key in ('albumArtRef', 'artistArtRef', 'art'):
+        if key in track:
+            url = track[key][0]['url']
+            if covers is not None:
+                cover = covers.get(url, host_limiter)
+            else:
+                try:
+                    cover = get_image_tuple_from_url(url, host_limiter)
+                except Exception, e:
+                    print("Error: " + str(e))
+                    print("Error retrieving cover: " + url)
+                    cover = None
+            if cover is not None:
+                # Otherwise the track is tagged without a cover
+                mime_type, image_data = cover
+                tag.images.set(ImageFrame.FRONT_COVER, image_data, mime_type)
+            break
+    # eyed3 only saves to files, and saving to an empty one leaves nothing in it but the tag
+    temp_file, temp_path = tempfile.mkstemp(suffix='.id3')
+    os.close(temp_file)
+    try:
+        tag.save(temp_path)
+        with open(temp_path, 'rb') as tag_file:
+            return tag_file.read()
+    finally:
+        remove_file(temp_path)
@@ -0,0 +1,756 @@
+import array
+import collections
+import cPickle
+import json
+import os
+import Queue
+import re
+import threading
+from datetime import datetime as dt
+
+# Track fields that can be searched from the "Search by" dropdown
+SEARCH_FIELDS = ('artist', 'genre', 'album', 'title')
+# Length of the n-grams stored in the search index
+GRAM_LENGTH = 3
+# Number of searches remembered by SearchIndex
+SEARCH_CACHE_SIZE = 64
+# File holding the last known copy of the library
+LIBRARY_CACHE_FILE = '.library_cache'
+# Bumped whenever the layout of the library cache file changes
+SNAPSHOT_VERSION = 2
+# Microseconds subtracted from the last modification time when asking for changes. Merging is idempotent, so
+# overlapping a day only costs a few tracks and covers any clock or time zone skew.
+SYNC_OVERLAP = 24 * 60 * 60 * 1000000
+# Track fields that are unique to each track and gain nothing from being shared between tracks
+UNIQUE_FIELDS = frozenset(('id', 'clientId', 'storeId', 'nid', 'title', 'durationMillis', 'estimatedSize',
+                           'creationTimestamp', 'lastModifiedTimestamp', 'recentTimestamp'))
+# Fields holding the ids a track can be referred to by
+IDENTITY_FIELDS = ('id', 'storeId', 'nid', 'episodeId')
+# Sort orders used for search results and for the downloader tree
+ARTIST_ORDER = ('artist', 'album', 'discNumber', 'trackNumber', 'title')
+ALBUM_ARTIST_ORDER = ('albumArtist', 'album', 'discNumber', 'trackNumber', 'title')
+# Fields that hold numbers. A missing value sorts as 0 instead of as an empty string.
+NUMERIC_FIELDS = frozenset(('discNumber', 'trackNumber', 'year'))
+# Characters that give a search term a meaning other than a plain substring
+REGEX_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+
+def get_track_id(track):
+    """
+    Gets the id used to request the stream of a track.
+    :param track: track dict or TrackRef
+    :return: library id, store id or podcast episode id, or None if the track has none of them
+    """
+    if 'id' in track:
+        return track['id']
+    elif 'storeId' in track:
+        return track['storeId']
+    elif 'episodeId' in track:
+        return track['episodeId']
+    return None
+
+
+def get_grams(text):
+    """
+    Splits text into its overlapping n-grams.
+    :param text: lowercase string
+    :return: set of GRAM_LENGTH long substrings
+    """
+    return set(text[i:i + GRAM_LENGTH] for i in range(len(text) - GRAM_LENGTH + 1))
+
+
+def get_search_pattern(query):
+    """
+    Converts the text typed in the search entry to a regular expression. Spaces separate alternative terms.
+    :param query: search text
+    :return: regular expression string
+    """
+    return query.replace(' ', '|')
+
+
+def is_refinement(query, new_query):
+    """
+    Determines if every track matching new_query also matches query, which is the case when each plain search
+    term was only extended, as happens while typing.
+    :param query: previous search text
+    :param new_query: current search text
+    :return: boolean
+    """
+    terms = get_search_pattern(query).split('|')
+    new_terms = get_search_pattern(new_query).split('|')
+    if len(terms) != len(new_terms):
+        return False
+    for term, new_term in zip(terms, new_terms):
+        if not term or REGEX_SPECIAL_CHARS.intersection(new_term) or term not in new_term:
+            return False
+    return True
+
+
+class Missing(object):
+    """
+    Marks a field that a track does not have. There is only one instance, MISSING, which survives pickling.
+    """
+    def __reduce__(self):
+        return 'MISSING'
+
+    def __repr__(self):
+        return 'MISSING'
+
+MISSING = Missing()
+
+
+class TrackRef(object):
+    """
+    Handle to a track stored in a TrackTable. Behaves like the gmusicapi track dict it was made from.
+    """
+    __slots__ = ('table', 'handle')
+
+    def __init__(self, table, handle):
+        """
+        TrackRef __init__ function
+        :param table: TrackTable holding the track
+        :param handle: integer handle of the track in table
+        :return: None
+        """
+        self.table = table
+        self.handle = handle
+
+    def __getitem__(self, field):
+        value = self.table.get(self.handle, field, MISSING)
+        if value is MISSING:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        self.table.set(self.handle, field, value)
+
+    def __contains__(self, field):
+        return self.table.get(self.handle, field, MISSING) is not MISSING
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return isinstance(other, TrackRef) and self.table is other.table and self.handle == other.handle
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.table), self.handle))
+
+    def __repr__(self):
+        return 'TrackRef(%d, %r)' % (self.handle, self.get('title'))
+
+    def get(self, field, default=None):
+        """
+        Gets a field of the track.
+        :param field: field name
+        :param default: value returned if the track does not have the field
+        :return: field value
+        """
+        return self.table.get(self.handle, field, default)
+
+    def keys(self):
+        """
+        :return: list of the fields the track has
+        """
+        return [field for field, column in self.table.columns.iteritems() if column[self.handle] is not MISSING]
+
+    def items(self):
+        """
+        :return: list of (field, value) tuples
+        """
+        return [(field, column[self.handle]) for field, column in self.table.columns.iteritems()
+                if column[self.handle] is not MISSING]
+
+    def to_dict(self):
+        """
+        :return: plain dict copy of the track
+        """
+        return dict(self.items())
+
+
+class TrackTable(object):
+    """
+    Columnar store for library tracks. Every field is a list indexed by an integer track handle, and values that
+    repeat between tracks, like artist, album and genre, are shared instead of stored once per track.
+    """
+    def __init__(self, tracks=()):
+        """
+        TrackTable __init__ function
+        :param tracks: iterable of track dicts to add
+        :return: None
+        """
+        self.columns = {}
+        self.size = 0
+        self.shared = {}
+        self.ranks = {}
+        self.identities = None
+        self.extend(tracks)
+
+    def __getstate__(self):
+        # Pickle already stores each shared value once, so the lookup table is rebuilt instead of saved.
+        return {'columns': self.columns, 'size': self.size}
+
+    def __setstate__(self, state):
+        self.columns = state['columns']
+        self.size = state['size']
+        self.shared = None
+        self.ranks = {}
+        self.identities = None
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, handle):
+        if handle < 0:
+            handle += self.size
+        if not 0 <= handle < self.size:
+            raise IndexError('track handle out of range')
+        return TrackRef(self, handle)
+
+    def __iter__(self):
+        for handle in xrange(self.size):
+            yield TrackRef(self, handle)
+
+    def share(self, value):
+        """
+        Returns the stored copy of value if an equal value is already in the table.
+        :param value: field value
+        :return: value or an equal, already stored, object
+        """
+        if self.shared is None:
+            self.shared = {}
+            for field, column in self.columns.iteritems():
+                if field not in UNIQUE_FIELDS:
+                    for stored in column:
+                        if stored is not MISSING:
+                            self.share(stored)
+        if isinstance(value, (list, dict)):
+            key = (list, json.dumps(value, sort_keys=True))
+        else:
+            key = (type(value), value)
+        return self.shared.setdefault(key, value)
+
+    def get(self, handle, field, default=None):
+        """
+        Gets a field of a track.
+        :param handle: track handle
+        :param field: field name
+        :param default: value returned if the track does not have the field
+        :return: field value
+        """
+        column = self.columns.get(field)
+        if column is None:
+            return default
+        value = column[handle]
+        if value is MISSING:
+            return default
+        return value
+
+    def set(self, handle, field, value):
+        """
+        Sets a field of a track.
+        :param handle: track handle
+        :param field: field name
+        :param value: new value
+        :return: None
+        """
+        column = self.columns.get(field)
+        if column is None:
+            column = self.columns[field] = [MISSING] * self.size
+        self.ranks.clear()
+        if field in IDENTITY_FIELDS:
+            self.identities = None
+        if field not in UNIQUE_FIELDS:
+            value = self.share(value)
+        column[handle] = value
+
+    def append(self, track):
+        """
+        Adds a track to the table.
+        :param track: track dict or TrackRef
+        :return: handle of the new track
+        """
+        handle = self.size
+        self.size += 1
+        self.ranks.clear()
+        for column in self.columns.itervalues():
+            column.append(MISSING)
+        for field, value in track.items():
+            self.set(handle, field, value)
+        return handle
+
+    def replace(self, handle, track):
+        """
+        Replaces every field of a track, keeping its handle.
+        :param handle: track handle
+        :param track: track dict or TrackRef
+        :return: None
+        """
+        self.ranks.clear()
+        self.identities = None
+        for field, column in self.columns.iteritems():
+            if field not in track:
+                column[handle] = MISSING
+        for field, value in track.items():
+            self.set(handle, field, value)
+
+    def extend(self, tracks):
+        """
+        Adds tracks to the table.
+        :param tracks: iterable of track dicts or TrackRefs
+        :return: None
+        """
+        for track in tracks:
+            self.append(track)
+
+    def column(self, field):
+        """
+        Gets every value of one field.
+        :param field: field name
+        :return: list indexed by track handle, with MISSING for tracks without the field
+        """
+        return self.columns.get(field, [MISSING] * self.size)
+
+    def get_rank(self, order):
+        """
+        Gets the position of every track when the whole library is sorted by the given fields. Ties keep library
+        order, the same as chaining stable sorts from the last field to the first. Computed once per order and
+        kept until the table changes.
+        :param order: tuple of field names, most significant first
+        :return: array indexed by track handle
+        """
+        rank = self.ranks.get(order)
+        if rank is None:
+            columns = []
+            for field in order:
+                default = 0 if field in NUMERIC_FIELDS else u''
+                columns.append([default if value is MISSING else value for value in self.column(field)])
+            handles = sorted(xrange(self.size), key=lambda handle: [column[handle] for column in columns])
+            rank = array.array('l', [0]) * self.size
+            for position, handle in enumerate(handles):
+                rank[handle] = position
+            self.ranks[order] = rank
+        return rank
+
+    def sort_key(self, order):
+        """
+        Gets a key function for sorting TrackRefs of this table with list.sort or sorted.
+        :param order: tuple of field names, most significant first
+        :return: function returning the integer rank of a TrackRef
+        """
+        rank = self.get_rank(order)
+        return lambda track: rank[track.handle]
+
+    def find(self, track_id):
+        """
+        Finds a track by any of its ids: library id, store id, nid or podcast episode id.
+        :param track_id: id string
+        :return: TrackRef or None if no track has that id
+        """
+        if self.identities is None:
+            self.identities = {}
+            for field in IDENTITY_FIELDS:
+                for handle, value in enumerate(self.column(field)):
+                    if value is not MISSING:
+                        self.identities.setdefault(value, handle)
+        handle = self.identities.get(track_id)
+        if handle is None:
+            return None
+        return TrackRef(self, handle)
+
+
+def resolve_playlist(tracks, entries):
+    """
+    Gets the tracks of a playlist in playlist order. Entries for store tracks that are not in the library use the
+    track metadata that comes with the playlist entry.
+    :param tracks: TrackTable of library tracks
+    :param entries: list of track entries from a gmusicapi playlist dict
+    :return: list of TrackRefs and track dicts
+    """
+    playlist_tracks = []
+    for entry in entries:
+        if entry.get('deleted', False):
+            continue
+        track = tracks.find(entry['trackId'])
+        if track is None:
+            track = entry.get('track')
+        if track is not None:
+            playlist_tracks.append(track)
+    return playlist_tracks
+
+
+class FieldIndex(object):
+    """
+    N-gram index over the distinct values of one track field.
+    """
+    def __init__(self):
+        """
+        FieldIndex __init__ function
+        :return: None
+        """
+        self.values = []
+        self.value_ids = {}
+        self.value_tracks = []
+        self.grams = {}
+
+    def add(self, value, position):
+        """
+        Adds the field value of the track at position to the index.
+        :param value: field value of the track
+        :param position: position of the track in the library
+        :return: None
+        """
+        value_id = self.value_ids.get(value)
+        if value_id is None:
+            value_id = len(self.values)
+            self.value_ids[value] = value_id
+            self.values.append(value)
+            self.value_tracks.append([])
+            for gram in get_grams(value.lower()):
+                self.grams.setdefault(gram, set()).add(value_id)
+        self.value_tracks[value_id].append(position)
+
+    def candidates(self, terms):
+        """
+        Finds the values that may contain one of the given plain terms.
+        :param terms: list of lowercase search terms, each at least GRAM_LENGTH long
+        :return: set of value ids
+        """
+        found = set()
+        for term in terms:
+            term_ids = None
+            for gram in get_grams(term):
+                gram_ids = self.grams.get(gram)
+                if gram_ids is None:
+                    term_ids = set()
+                    break
+                if term_ids is None:
+                    term_ids = set(gram_ids)
+                else:
+                    term_ids &= gram_ids
+                if not term_ids:
+                    break
+            found.update(term_ids)
+        return found
+
+    def search(self, query, within=None):
+        """
+        Finds the field values that match the query.
+        :param query: search text, spaces separate alternative terms
+        :param within: value ids to limit the search to, typically the matches of a query this one refines
+        :return: frozenset of value ids
+        """
+        pattern = get_search_pattern(query)
+        try:
+            regex = re.compile(pattern, flags=re.I)
+        except re.error:
+            return frozenset()
+        terms = pattern.split('|')
+        plain = all(len(term) >= GRAM_LENGTH and not REGEX_SPECIAL_CHARS.intersection(term) for term in terms)
+        if within is not None:
+            value_ids = within
+        elif plain:
+            value_ids = self.candidates([term.lower() for term in terms])
+        else:
+            value_ids = xrange(len(self.values))
+        return frozenset(value_id for value_id in value_ids if regex.search(self.values[value_id]))
+
+    def get_positions(self, value_ids):
+        """
+        Gets the tracks having any of the given values.
+        :param value_ids: value ids
+        :return: list of track positions in library order
+        """
+        positions = []
+        for value_id in value_ids:
+            positions.extend(self.value_tracks[value_id])
+        positions.sort()
+        return positions
+
+
+class SearchIndex(object):
+    """
+    In-memory index over the searchable fields of the library. Gives the same matches as running the search
+    regular expression on every track.
+    """
+    def __init__(self, tracks):
+        """
+        SearchIndex __init__ function
+        :param tracks: TrackTable of library tracks
+        :return: None
+        """
+        self.tracks = tracks
+        self.fields = {}
+        for field in SEARCH_FIELDS:
+            self.fields[field] = FieldIndex()
+        self.size = 0
+        self.cache = collections.OrderedDict()
+        self.last_search = None
+        self.update()
+
+    def update(self):
+        """
+        Indexes the tracks appended to the library since the index was built or last updated.
+        :return: None
+        """
+        if self.size == len(self.tracks):
+            return
+        for field in SEARCH_FIELDS:
+            field_index = self.fields[field]
+            column = self.tracks.column(field)
+            for position in xrange(self.size, len(self.tracks)):
+                value = column[position]
+                if value is MISSING:
+                    value = u''
+                field_index.add(value, position)
+        self.size = len(self.tracks)
+        self.cache.clear()
+        self.last_search = None
+
+    def search(self, field, query):
+        """
+        Searches the library. Recent searches are answered from a cache, and a query that extends the previous
+        one only rechecks the previous matches.
+        :param field: track field to search, one of SEARCH_FIELDS
+        :param query: search text, spaces separate alternative terms
+        :return: list of matching tracks in library order
+        """
+        key = (field, query)
+        cached = self.cache.pop(key, None)
+        if cached is None:
+            within = None
+            if self.last_search is not None:
+                last_key, last_value_ids = self.last_search
+                if last_key[0] == field and is_refinement(last_key[1], query):
+                    within = last_value_ids
+            field_index = self.fields[field]
+            value_ids = field_index.search(query, within)
+            cached = (value_ids, field_index.get_positions(value_ids))
+            if len(self.cache) >= SEARCH_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        self.cache[key] = cached
+        self.last_search = (key, cached[0])
+        return [TrackRef(self.tracks, position) for position in cached[1]]
+
+
+def load_snapshot(filename=LIBRARY_CACHE_FILE):
+    """
+    Loads the library saved by save_snapshot.
+    :param filename: library cache file
+    :return: TrackTable or None if there is no usable snapshot
+    """
+    try:
+        with open(filename, 'rb') as cached:
+            snapshot = cPickle.load(cached)
+    except Exception, e:
+        if os.path.exists(filename):
+            print("Error: " + str(e))
+            print("Error reading library cache. The library will be downloaded again.")
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    return snapshot['tracks']
+
+
+def save_snapshot(tracks, filename=LIBRARY_CACHE_FILE):
+    """
+    Saves the library so the next start can load it without downloading it.
+    :param tracks: TrackTable of library tracks
+    :param filename: library cache file
+    :return: None
+    """
+    temp_filename = filename + '.tmp'
+    try:
+        with open(temp_filename, 'wb') as cached:
+            cPickle.dump({'version': SNAPSHOT_VERSION, 'tracks': tracks}, cached, cPickle.HIGHEST_PROTOCOL)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp_filename, filename)
+    except (IOError, OSError), e:
+        print("Error: " + str(e))
+        print("Error saving library cache.")
+
+
+def get_last_modified(tracks):
+    """
+    Gets the most recent modification time in the library.
+    :param tracks: TrackTable of library tracks
+    :return: modification time in microseconds since the epoch
+    """
+    last_modified = 0
+    for timestamp in tracks.column('lastModifiedTimestamp'):
+        if timestamp is not MISSING:
+            last_modified = max(last_modified, int(timestamp))
+    return last_modified
+
+
+def merge_updates(tracks, updates):
+    """
+    Applies changed tracks to the library. The sync asks for an overlap, so updates that are not newer than the
+    stored track are skipped. Changed tracks are replaced in place and new tracks are appended; the table is only
+    rebuilt when tracks were deleted.
+    :param tracks: TrackTable of library tracks
+    :param updates: list of tracks changed since the library was saved
+    :return: TrackTable with the changes, which is tracks unless tracks were deleted, or None if nothing changed
+    """
+    changes = collections.OrderedDict()
+    for update in updates:
+        stored = tracks.find(update['id'])
+        if stored is None:
+            if update.get('deleted', False):
+                continue
+        elif int(update.get('lastModifiedTimestamp', 0)) <= int(stored.get('lastModifiedTimestamp', 0)):
+            continue
+        changes[update['id']] = (stored, update)
+    if not changes:
+        return None
+    if any(update.get('deleted', False) for stored, update in changes.itervalues()):
+        merged = TrackTable()
+        for track in tracks:
+            change = changes.pop(track['id'], None)
+            if change is not None:
+                track = change[1]
+            if not track.get('deleted', False):
+                merged.append(track)
+        for stored, update in changes.itervalues():
+            if not update.get('deleted', False):
+                merged.append(update)
+        return merged
+    # Looked up before anything changes, as every change to an id makes the next lookup rebuild the id index
+    for stored, update in changes.itervalues():
+        if stored is None:
+            tracks.append(update)
+        else:
+            tracks.replace(stored.handle, update)
+    return tracks
+
+
+class LibraryLoader(threading.Thread):
+    """
+    Thread that downloads the library page by page. Without a snapshot it downloads every track, otherwise only
+    the tracks changed since the snapshot was saved. Pages are handed to the Tk thread through a queue.
+    """
+    def __init__(self, mobile_client, snapshot=None):
+        """
+        LibraryLoader __init__ function
+        :param mobile_client: GMusicAPI Mobileclient instance
+        :param snapshot: TrackTable loaded from the library cache, or None to download the whole library
+        :return: None
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.mobile_client = mobile_client
+        self.full = snapshot is None
+        self.last_modified = 0 if snapshot is None else get_last_modified(snapshot)
+        self.pages = Queue.Queue()
+        self.updates = []
+        self.loaded = 0
+        self.done = False
+        self.error = None
+
+    def run(self):
+        """
+        Thread body. Puts every page of tracks on the pages queue, followed by None when finished or the exception
+        raised.
+        :return: None
+        """
+        try:
+            if self.full:
+                pages = self.mobile_client.get_all_songs(incremental=True)
+            else:
+                since = max(self.last_modified - SYNC_OVERLAP, 0)
+                pages = self.mobile_client.get_all_songs(incremental=True, include_deleted=True,
+                                                         updated_after=dt.utcfromtimestamp(since / 1000000.0))
+            for page in pages:
+                self.pages.put(page)
+        except Exception, e:
+            self.pages.put(e)
+            return
+        self.pages.put(None)
+
+    def receive(self, tracks):
+        """
+        Takes the pages that have arrived without blocking. When downloading the whole library they are appended to
+        tracks straight away, otherwise they are kept for finish.
+        :param tracks: TrackTable of library tracks
+        :return: number of tracks appended to tracks
+        """
+        appended = 0
+        while not self.done:
+            try:
+                page = self.pages.get_nowait()
+            except Queue.Empty:
+                break
+            if page is None:
+                self.done = True
+            elif isinstance(page, Exception):
+                self.done = True
+                self.error = page
+            elif self.full:
+                tracks.extend(page)
+                appended += len(page)
+                self.loaded += len(page)
+            else:
+                self.updates.extend(page)
+                self.loaded += len(page)
+        return appended
+
+    def finish(self, tracks):
+        """
+        Saves the library once the loader is done, merging the changed tracks into it first when syncing a snapshot.
+        The snapshot is only saved again if the sync changed something.
+        :param tracks: TrackTable of library tracks
+        :return: TrackTable holding the changes, which may be tracks itself, or None if the library did not change
+        """
+        if self.error is not None:
+            print("Error: " + str(self.error))
+            if self.full:
+                print("Error downloading library. Only part of the library was loaded.")
+            else:
+                print("Error syncing library. Using the saved library.")
+            return None
+        if self.full:
+            save_snapshot(tracks)
+            return None
+        merged = merge_updates(tracks, self.updates)
+        if merged is not None:
+            save_snapshot(merged)
+        return merged
+
+
+def open_library(mobile_client):
+    """
+    Opens the library from the snapshot if there is one and starts loading the rest in the background.
+    :param mobile_client: GMusicAPI Mobileclient instance
+    :return: tuple of the TrackTable, empty if there was no snapshot, and the started LibraryLoader
+    """
+    snapshot = load_snapshot()
+    loader = LibraryLoader(mobile_client, snapshot)
+    loader.start()
+    if snapshot is None:
+        return TrackTable(), loader
+    return snapshot, loader
+
+
+def load_library(mobile_client):
+    """
+    Opens the library and waits for the loader to finish, for programs without a Tk loop to poll it from.
+    :param mobile_client: GMusicAPI Mobileclient instance
+    :return: tuple of the TrackTable and the error the loader stopped on, or None. A sync of the snapshot that fails
+        is printed and gives None, as the saved library is still complete
+    """
+    tracks, loader = open_library(mobile_client)
+    loader.join()
+    loader.receive(tracks)
+    merged = loader.finish(tracks)
+    if merged is not None:
+        tracks = merged
+    if not loader.full:
+        return tracks, None
+    return tracks, loader.error
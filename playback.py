@@ -0,0 +1,174 @@
+import time
+
+# Bytes per second of a 320 kbps track, the highest bitrate Google Play Music streams
+STREAM_BYTE_RATE = 40000
+# Milliseconds of audio buffered before playing: without a measured rate, bounds, and the amount buffered on a link
+# exactly as fast as a track's bitrate
+DEFAULT_BUFFER_DURATION = 2000
+MIN_BUFFER_DURATION = 1000
+MAX_BUFFER_DURATION = 30000
+TARGET_BUFFER_DURATION = 5000
+MIN_BUFFER_SIZE = 2 * 1024 * 1024
+# Seconds between download rate samples, and the weight of a new sample
+RATE_SAMPLE_TIME = 0.5
+RATE_SMOOTHING = 0.3
+
+
+class PlaybackClock(object):
+    """
+    Playback position kept from the last time the backend reported it. While running, the position is advanced by
+    the wall clock time since that report, so asking for it never has to wait on the backend.
+    """
+    def __init__(self):
+        """
+        PlaybackClock __init__ function
+        :return: None
+        """
+        self.position = 0
+        self.stamp = None
+
+    def is_running(self):
+        """
+        :return: True if the position is advancing
+        """
+        return self.stamp is not None
+
+    def start(self):
+        """
+        Starts advancing the position, as when playback starts or resumes.
+        :return: None
+        """
+        if self.stamp is None:
+            self.stamp = time.time()
+
+    def stop(self):
+        """
+        Stops advancing the position, keeping the current value, as when playback pauses or stalls.
+        :return: None
+        """
+        self.position = self.get_position()
+        self.stamp = None
+
+    def sync(self, position):
+        """
+        Sets the position to the one reported by the backend.
+        :param position: position in ms
+        :return: None
+        """
+        self.position = position
+        if self.stamp is not None:
+            self.stamp = time.time()
+
+    def reset(self):
+        """
+        Stops the clock and moves it back to the start of the track.
+        :return: None
+        """
+        self.position = 0
+        self.stamp = None
+
+    def get_position(self):
+        """
+        :return: current position in ms
+        """
+        if self.stamp is None:
+            return self.position
+        return self.position + int((time.time() - self.stamp) * 1000)
+
+
+class BufferTuner(object):
+    """
+    Buffering telemetry of a backend: the buffering percentage, bytes downloaded, download rate and underruns. The
+    rate is only sampled while the backend is filling its buffer, as a full buffer throttles the download to the
+    bitrate of the track. Slower links and more underruns get a larger prebuffer.
+    """
+    def __init__(self):
+        """
+        BufferTuner __init__ function
+        :return: None
+        """
+        self.percent = 100
+        self.bytes = 0
+        self.rate = None
+        self.underruns = 0
+        self.filled = False
+        self.sample = None
+
+    def start_stream(self):
+        """
+        Marks the start of a new track, whose first fill of the buffer is not an underrun. The buffer is taken as full
+        until the backend reports otherwise, so a percentage left by the last track is not sampled against this one.
+        :return: None
+        """
+        self.percent = 100
+        self.filled = False
+        self.sample = None
+
+    def update(self, total_bytes):
+        """
+        Takes the number of bytes the backend has downloaded so far, sampling the download rate if it is buffering.
+        :param total_bytes: bytes downloaded, never going down
+        :return: None
+        """
+        now = time.time()
+        if self.sample is not None and self.percent < 100:
+            elapsed = now - self.sample[0]
+            if elapsed >= RATE_SAMPLE_TIME:
+                rate = (total_bytes - self.sample[1]) / elapsed
+                if self.rate is None:
+                    self.rate = rate
+                else:
+                    self.rate += RATE_SMOOTHING * (rate - self.rate)
+                self.sample = (now, total_bytes)
+        else:
+            self.sample = (now, total_bytes)
+        self.bytes = total_bytes
+
+    def set_percent(self, percent, playing):
+        """
+        Takes a buffering percentage reported by the backend, counting an underrun when the buffer runs low after
+        having been filled.
+        :param percent: buffer fill level from 0 to 100
+        :param playing: True if playback is meant to be running
+        :return: None
+        """
+        if percent >= 100:
+            self.filled = True
+        elif self.filled and playing and self.percent >= 100:
+            self.underruns += 1
+        self.percent = percent
+
+    def get_buffer_duration(self):
+        """
+        Gets how much audio to buffer before playing: more the slower the link is compared to the bitrate of a
+        track, and more after every underrun.
+        :return: duration in ms
+        """
+        if self.rate is None:
+            duration = DEFAULT_BUFFER_DURATION
+        elif self.rate <= 0:
+            duration = MAX_BUFFER_DURATION
+        else:
+            duration = int(TARGET_BUFFER_DURATION * STREAM_BYTE_RATE / self.rate)
+        duration *= 1 + self.underruns
+        return max(MIN_BUFFER_DURATION, min(MAX_BUFFER_DURATION, duration))
+
+    def get_buffer_size(self):
+        """
+        Gets the buffer size in bytes, big enough to hold the buffer duration of a variable bitrate track.
+        :return: size in bytes
+        """
+        return max(MIN_BUFFER_SIZE, self.get_buffer_duration() * STREAM_BYTE_RATE * 2 / 1000)
+
+    def get_stats(self):
+        """
+        :return: dict with the buffering percent, bytes downloaded, download rate in bytes per second (None until
+            measured), underruns and the current buffer duration in ms
+        """
+        return {
+            'percent': self.percent,
+            'bytes': self.bytes,
+            'rate': self.rate,
+            'underruns': self.underruns,
+            'buffer_duration': self.get_buffer_duration(),
+        }
@@ -1,74 +1,242 @@
+import threading
+
 import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst
 Gst.init(None)
 
-TIMEOUT = 1000
+from playback import BufferTuner, PlaybackClock
+
+PLAYING_STATES = (Gst.State.PLAYING, Gst.State.PAUSED, Gst.State.READY)
+
 
 class Player(object):
+    """
+    GStreamer playbin backend. Nothing here waits on the pipeline: state, duration and errors are taken from the
+    bus by poll, which also calls the callbacks registered with connect. The events are state-changed(state),
+    eos(), error(message), duration-changed(duration), buffering(percent) and track-changed(). The position comes
+    from a PlaybackClock synced to the pipeline whenever it can answer a position query. While buffering, the
+    pipeline is held in PAUSED without changing the target state, and the prebuffer of each track is sized by a
+    BufferTuner from the bytes counted on the source element.
+    """
     def __init__(self):
         self.url = None
+        self.next_url = None
+        self.pending_changes = 0
+        self.lock = threading.Lock()
+        self.state = Gst.State.NULL
+        self.target_state = Gst.State.NULL
+        self.error = None
+        self.duration = 0
+        self.clock = PlaybackClock()
+        self.pending_seek = None
+        self.tuner = BufferTuner()
+        self.bytes = 0
+        self.buffering = False
+        self.callbacks = {}
         self.playbin = Gst.ElementFactory.make("playbin", "player")
         fakesink = Gst.ElementFactory.make("fakesink", "fakesink")
         self.playbin.set_property("video-sink", fakesink)
+        self.playbin.connect('about-to-finish', self.on_about_to_finish)
+        self.playbin.connect('source-setup', self.on_source_setup)
+        self.bus = self.playbin.get_bus()
+        self.handlers = {
+            Gst.MessageType.STATE_CHANGED: self.on_state_changed,
+            Gst.MessageType.EOS: self.on_eos,
+            Gst.MessageType.ERROR: self.on_error,
+            Gst.MessageType.DURATION_CHANGED: self.on_duration_changed,
+            Gst.MessageType.BUFFERING: self.on_buffering,
+            Gst.MessageType.STREAM_START: self.on_stream_start,
+        }
+
+    def connect(self, event, callback):
+        """
+        Registers a callback for a player event. Callbacks are called from poll, so on the thread that polls.
+        :param event: event name
+        :param callback: function taking the event arguments
+        :return: None
+        """
+        self.callbacks.setdefault(event, []).append(callback)
+
+    def emit(self, event, *args):
+        for callback in self.callbacks.get(event, []):
+            callback(*args)
+
+    def poll(self):
+        """
+        Handles the messages waiting on the bus. Never blocks.
+        :return: None
+        """
+        message = self.bus.pop()
+        while message is not None:
+            handler = self.handlers.get(message.type)
+            if handler is not None:
+                handler(message)
+            message = self.bus.pop()
+        self.tuner.update(self.bytes)
+
+    def on_state_changed(self, message):
+        if message.src != self.playbin:
+            return
+        old, new, pending = message.parse_state_changed()
+        self.state = new
+        if new == Gst.State.PLAYING:
+            self.clock.start()
+        else:
+            self.clock.stop()
+        if self.pending_seek is not None and new in (Gst.State.PAUSED, Gst.State.PLAYING):
+            position = self.pending_seek
+            self.pending_seek = None
+            self.set_position(position)
+        self.emit('state-changed', new)
+
+    def on_eos(self, message):
+        self.clock.stop()
+        self.emit('eos')
+
+    def on_error(self, message):
+        error, debug = message.parse_error()
+        self.error = error.message
+        self.emit('error', self.error)
+
+    def on_duration_changed(self, message):
+        self.duration = 0
+        self.emit('duration-changed', self.get_duration())
+
+    def on_buffering(self, message):
+        percent = message.parse_buffering()
+        self.tuner.set_percent(percent, self.target_state == Gst.State.PLAYING)
+        if percent < 100 and not self.buffering and self.target_state == Gst.State.PLAYING:
+            self.buffering = True
+            self.playbin.set_state(Gst.State.PAUSED)
+        elif percent >= 100 and self.buffering:
+            self.buffering = False
+            if self.target_state == Gst.State.PLAYING:
+                self.playbin.set_state(Gst.State.PLAYING)
+        self.emit('buffering', percent)
 
-    def wait_for_state(self):
-        while self.playbin.get_state(TIMEOUT)[0] == Gst.StateChangeReturn.ASYNC:
-            continue
-        if self.playbin.get_state(TIMEOUT)[0] == Gst.StateChangeReturn.FAILURE:
+    def on_source_setup(self, playbin, source):
+        pad = source.get_static_pad('src')
+        if pad is not None:
+            pad.add_probe(Gst.PadProbeType.BUFFER, self.count_bytes)
+
+    def count_bytes(self, pad, info):
+        # Called from a GStreamer streaming thread for every buffer the source element pushes
+        self.bytes += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+
+    def get_buffering_stats(self):
+        """
+        :return: dict with the buffering percent, bytes downloaded, download rate, underruns and buffer duration
+        """
+        return self.tuner.get_stats()
+
+    def on_stream_start(self, message):
+        with self.lock:
+            changed = self.pending_changes > 0
+            if changed:
+                self.pending_changes -= 1
+        if changed:
+            self.duration = 0
+            self.clock.reset()
+            self.clock.start()
+            self.emit('track-changed')
+
+    def set_state(self, state):
+        self.target_state = state
+        result = self.playbin.set_state(state)
+        if result == Gst.StateChangeReturn.FAILURE:
+            self.error = 'State change failed'
             return False
+        if result == Gst.StateChangeReturn.SUCCESS:
+            self.state = state
         return True
 
     def load_url(self, url):
+        self.clear_queue()
         self.url = url
+        self.duration = 0
+        self.clock.reset()
+        self.pending_seek = None
+        self.buffering = False
+        self.tuner.start_stream()
+        self.playbin.set_property('buffer-duration', self.tuner.get_buffer_duration() * 1000000)
+        self.playbin.set_property('buffer-size', self.tuner.get_buffer_size())
         self.playbin.set_property('uri', url)
 
+    def queue_url(self, url):
+        """
+        Sets the url to continue with, without a gap, when the current one finishes.
+        :param url: stream url of the next track
+        :return: True, since this backend supports gapless playback
+        """
+        with self.lock:
+            self.next_url = url
+        return True
+
+    def clear_queue(self):
+        with self.lock:
+            self.next_url = None
+            self.pending_changes = 0
+
+    def on_about_to_finish(self, playbin):
+        # Called from a GStreamer streaming thread. Setting the uri here makes playbin continue with it gaplessly.
+        with self.lock:
+            url = self.next_url
+            self.next_url = None
+            if url is None:
+                return
+            self.url = url
+            self.pending_changes += 1
+        playbin.set_property('uri', url)
+
     def play(self):
-        self.playbin.set_state(Gst.State.PLAYING)
-        return self.wait_for_state()
+        self.error = None
+        self.buffering = False
+        return self.set_state(Gst.State.PLAYING)
 
     def is_playing(self):
-        if not self.wait_for_state():
+        if self.error is not None:
             return False
-        state = self.playbin.get_state(TIMEOUT)[1]
-        #print state
-        if state == Gst.State.PLAYING\
-                or state == Gst.State.PAUSED\
-                or state == Gst.State.READY:
-            return True
-        return False
+        return self.target_state in PLAYING_STATES
 
     def stop(self):
-        self.playbin.set_state(Gst.State.NULL)
-        return self.wait_for_state()
+        self.clear_queue()
+        self.pending_seek = None
+        self.clock.reset()
+        return self.set_state(Gst.State.NULL)
 
     def pause(self):
-        self.playbin.set_state(Gst.State.PAUSED)
-        return self.wait_for_state()
+        self.clock.stop()
+        return self.set_state(Gst.State.PAUSED)
 
     def unpause(self):
         return self.play()
 
     def get_duration(self):
-        success = False
-        i = 0
-        while not success:
+        if self.duration <= 0:
             success, dur = self.playbin.query_duration(Gst.Format.TIME)
-            i += 1
-            if i > 1000:
-                return 0
-        return dur / 1000000
+            if success and dur > 0:
+                self.duration = dur / 1000000
+        return self.duration
 
     def get_position(self):
-        success = False
-        i = 0
-        while not success:
-            success, pos = self.playbin.query_position(Gst.Format.TIME)
-            i += 1
-            if i > 1000:
-                return 0
-        return pos / 1000000
+        """
+        Gets the playback position. Never blocks.
+        :return: position in ms
+        """
+        success, pos = self.playbin.query_position(Gst.Format.TIME)
+        if success:
+            self.clock.sync(pos / 1000000)
+        position = self.clock.get_position()
+        if 0 < self.duration < position:
+            return self.duration
+        return position
 
     def set_position(self, position):
-        self.playbin.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH, position * 1000000)
-        return self.wait_for_state()
+        self.clock.sync(int(position))
+        if self.state not in (Gst.State.PAUSED, Gst.State.PLAYING):
+            # Seeking needs a prerolled pipeline, so it is done once the state change arrives on the bus
+            self.pending_seek = position
+            return True
+        return self.playbin.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH, int(position * 1000000))
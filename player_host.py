@@ -0,0 +1,403 @@
+import json
+import os
+import Queue
+import subprocess
+import sys
+import threading
+import time
+
+from playback import PlaybackClock
+
+# Seconds between the host polling its backend and reporting its status
+HOST_INTERVAL = 0.05
+# Seconds without a message from the host before it is taken to be hung and restarted
+HANG_TIMEOUT = 5
+# Restarts of the host while playing the same track before giving up on it
+MAX_RESTARTS = 3
+HOST_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'player_host.py')
+COMMANDS = ('load_url', 'queue_url', 'play', 'stop', 'pause', 'unpause', 'set_position')
+EVENTS = ('state-changed', 'eos', 'error', 'duration-changed', 'buffering', 'track-changed')
+
+
+def to_json_value(value):
+    """
+    Converts a backend value, like a GStreamer or VLC state, to something json can encode.
+    :param value: any value
+    :return: value, or its string form
+    """
+    if value is None or type(value) in (bool, int, long, float) or isinstance(value, (basestring, dict)):
+        return value
+    if isinstance(value, (int, long)):
+        # Like a GStreamer state, a GEnum json would write with its repr
+        return int(value)
+    return str(value)
+
+
+class RemotePlayer(object):
+    """
+    Player running in a host process, so the GStreamer or VLC calls never run on the Tk thread. Commands are queued to
+    the host and nothing waits on its answers: the state, duration and position are mirrored from the status the host
+    reports, and the events it sends are handed to the callbacks registered with connect by poll, like the backends
+    do. A host that stops reporting is killed and restarted, picking up the track where it was. A host that exits
+    before it is ready could not load a backend, and is not restarted.
+    """
+    def __init__(self, backends):
+        """
+        RemotePlayer __init__ function
+        :param backends: names of the backend modules the host should try, in order
+        :return: None
+        """
+        self.backends = backends
+        self.callbacks = {}
+        self.events = Queue.Queue()
+        self.process = None
+        self.commands = None
+        self.sent = 0
+        self.handled = 0
+        self.restarts = 0
+        self.ready = False
+        self.last_message = time.time()
+        self.url = None
+        self.next_url = None
+        self.playing = False
+        self.paused = False
+        self.host_playing = False
+        self.error = None
+        self.failed = None
+        self.closed = False
+        self.gapless = True
+        self.duration = 0
+        self.buffering_stats = {}
+        self.clock = PlaybackClock()
+        self.start_host()
+
+    def start_host(self):
+        """
+        Starts a host process, with threads writing its commands and reading its messages.
+        :return: None
+        """
+        self.process = process = subprocess.Popen([sys.executable, '-u', HOST_SCRIPT] + list(self.backends),
+                                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.commands = commands = Queue.Queue()
+        self.sent = 0
+        self.handled = 0
+        self.ready = False
+        self.last_message = time.time()
+
+        def write():
+            while True:
+                line = commands.get()
+                try:
+                    if line is None:
+                        process.stdin.close()
+                        return
+                    process.stdin.write(line + '\n')
+                    process.stdin.flush()
+                except (IOError, ValueError):
+                    return
+
+        def read():
+            for line in iter(process.stdout.readline, ''):
+                try:
+                    self.events.put((process, json.loads(line)))
+                except ValueError:
+                    print("Error: Bad message from player host: " + line.rstrip())
+            self.events.put((process, {'event': 'exit', 'args': []}))
+
+        for target in (write, read):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop_host(self):
+        """
+        Kills the host process, if there is one.
+        :return: None
+        """
+        if self.process is None:
+            return
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.commands.put(None)
+        self.process = None
+
+    def restart_host(self):
+        """
+        Replaces the host process with a new one, loading the track it was playing at the same position.
+        :return: None
+        """
+        self.stop_host()
+        self.restarts += 1
+        if self.restarts > MAX_RESTARTS:
+            # The track itself seems to bring the backend down, so no host is started until another track is loaded
+            self.error = 'Player host failed ' + str(self.restarts) + ' times on the same track'
+            print("Error: " + self.error)
+            self.emit('error', self.error)
+            return
+        print('Restarting player host...')
+        self.start_host()
+        position = self.clock.get_position()
+        next_url = self.next_url
+        if self.url is not None:
+            self.send('load_url', self.url)
+            if self.playing:
+                self.send('play')
+                if self.paused:
+                    self.send('pause')
+                if position > 0:
+                    self.send('set_position', position)
+        if next_url is not None:
+            self.queue_url(next_url)
+
+    def send(self, command, *args):
+        if self.process is None:
+            return
+        self.sent += 1
+        self.commands.put(json.dumps({'command': command, 'args': args}))
+
+    def connect(self, event, callback):
+        """
+        Registers a callback for a player event. Callbacks are called from poll, so on the thread that polls.
+        :param event: event name
+        :param callback: function taking the event arguments
+        :return: None
+        """
+        self.callbacks.setdefault(event, []).append(callback)
+
+    def emit(self, event, *args):
+        for callback in self.callbacks.get(event, []):
+            callback(*args)
+
+    def poll(self):
+        """
+        Handles the messages the host sent, and restarts it if it died or hung. Never blocks.
+        :return: None
+        """
+        while True:
+            try:
+                process, message = self.events.get_nowait()
+            except Queue.Empty:
+                break
+            if process is not self.process:
+                continue  # Left over from a host that was replaced
+            self.last_message = time.time()
+            event, args = message['event'], message['args']
+            if event == 'exit':
+                if not self.ready:
+                    self.stop_host()
+                    if self.error is None:
+                        # Otherwise the host already sent the reason as an error
+                        self.error = 'Player host exited before it was ready'
+                        print("Error: " + self.error)
+                        self.emit('error', self.error)
+                    self.failed = self.error
+                    return
+                self.restart_host()
+                return
+            self.handle(event, args)
+        if self.process is not None and time.time() - self.last_message > HANG_TIMEOUT:
+            print('Player host is not responding')
+            self.restart_host()
+
+    def handle(self, event, args):
+        if event == 'ready':
+            self.ready = True
+        elif event == 'status':
+            position, duration, playing, running, handled, self.buffering_stats = args
+            self.handled = handled
+            if handled == self.sent:
+                # Only trusted once the host caught up with the commands, so it does not undo the latest one
+                self.clock.sync(position)
+                if running:
+                    self.clock.start()
+                else:
+                    self.clock.stop()
+                self.host_playing = playing
+            if duration > 0:
+                self.duration = duration
+        elif event == 'result':
+            command, value = args
+            if command == 'queue_url':
+                self.gapless = value
+        else:
+            if event == 'error':
+                self.error = args[0]
+            elif event == 'duration-changed':
+                self.duration = args[0]
+            elif event == 'track-changed':
+                self.url = self.next_url
+                self.next_url = None
+                self.duration = 0
+                self.clock.reset()
+                self.clock.start()
+            elif event == 'eos':
+                self.clock.stop()
+            self.emit(event, *args)
+
+    def has_given_up(self):
+        """
+        :return: True if the host kept failing on the current track and was not restarted
+        """
+        return self.restarts > MAX_RESTARTS
+
+    def load_url(self, url):
+        if url != self.url:
+            self.restarts = 0
+        if self.process is None and self.failed is None and not self.closed and not self.has_given_up():
+            self.start_host()
+        self.url = url
+        self.next_url = None
+        self.duration = 0
+        self.clock.reset()
+        self.send('load_url', url)
+
+    def queue_url(self, url):
+        """
+        Sets the url to continue with when the current one finishes.
+        :param url: stream url of the next track
+        :return: True if the backend last said it supports gapless playback
+        """
+        self.next_url = url
+        self.send('queue_url', url)
+        return self.gapless
+
+    def play(self):
+        self.error = None
+        self.playing = True
+        self.paused = False
+        self.send('play')
+        return True
+
+    def is_playing(self):
+        if self.error is not None or not self.playing:
+            return False
+        if self.handled == self.sent:
+            return self.host_playing
+        return True
+
+    def stop(self):
+        self.playing = False
+        self.paused = False
+        self.next_url = None
+        self.clock.reset()
+        self.send('stop')
+        return True
+
+    def pause(self):
+        self.paused = True
+        self.clock.stop()
+        self.send('pause')
+        return True
+
+    def unpause(self):
+        self.paused = False
+        self.send('unpause')
+        return True
+
+    def get_duration(self):
+        return self.duration
+
+    def get_position(self):
+        """
+        Gets the playback position. Never blocks.
+        :return: position in ms
+        """
+        position = self.clock.get_position()
+        if 0 < self.duration < position:
+            return self.duration
+        return position
+
+    def set_position(self, position):
+        self.clock.sync(int(position))
+        self.send('set_position', position)
+        return True
+
+    def get_buffering_stats(self):
+        """
+        :return: dict with the buffering percent, bytes downloaded, download rate, underruns and buffer duration, as
+            last reported by the host
+        """
+        return self.buffering_stats
+
+    def close(self):
+        """
+        Asks the host to stop its backend and exit.
+        :return: None
+        """
+        if self.process is not None:
+            self.commands.put(None)
+            self.process = None
+        self.closed = True
+
+
+def run_host(backends):
+    """
+    Runs a backend for a RemotePlayer, taking commands as json lines on stdin and sending its events and status as
+    json lines on stdout.
+    :param backends: names of the backend modules to try, in order
+    :return: exit status
+    """
+    channel = sys.stdout
+    sys.stdout = sys.stderr  # Anything the backends print must not get mixed into the messages
+
+    def send(event, *args):
+        channel.write(json.dumps({'event': event, 'args': [to_json_value(arg) for arg in args]}) + '\n')
+        channel.flush()
+
+    player = None
+    for backend in backends:
+        try:
+            player = __import__(backend, fromlist=['Player']).Player()
+            break
+        except ImportError, e:
+            print("Error: " + str(e))
+    if player is None:
+        send('error', 'No player backend could be loaded')
+        return 1
+
+    def forward(event):
+        return lambda *args: send(event, *args)
+
+    for event in EVENTS:
+        player.connect(event, forward(event))
+    send('ready', backend)
+
+    commands = Queue.Queue()
+
+    def read():
+        for line in iter(sys.stdin.readline, ''):
+            commands.put(json.loads(line))
+        commands.put(None)
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    handled = 0
+    while True:
+        deadline = time.time() + HOST_INTERVAL
+        while True:
+            try:
+                message = commands.get(timeout=max(0, deadline - time.time()))
+            except Queue.Empty:
+                break
+            if message is None:
+                player.stop()
+                return 0
+            command, args = message['command'], message['args']
+            result = None
+            if command in COMMANDS:
+                result = getattr(player, command)(*args)
+            handled += 1
+            if command == 'queue_url':
+                send('result', command, result)
+            elif command == 'set_position' and result is False:
+                send('error', 'Seeking failed')
+        player.poll()
+        send('status', player.get_position(), player.get_duration(), player.is_playing(), player.clock.is_running(),
+             handled, player.get_buffering_stats())
+
+
+if __name__ == '__main__':
+    sys.exit(run_host(sys.argv[1:]))
@@ -1,12 +1,84 @@
+import Queue
+
 import vlc
 
+from playback import BufferTuner, PlaybackClock
+
 
 class Player(object):
+    """
+    VLC backend. VLC reports its events on its own thread, so they are queued and the callbacks registered with
+    connect are called from poll. The events are the same as the GStreamer backend's. VLC only updates its time
+    a few times a second, so the position comes from a PlaybackClock synced to it. The network caching of each track
+    is sized by a BufferTuner from the bytes VLC reports reading.
+    """
     def __init__(self):
         self.media_player = vlc.MediaPlayer()
+        self.clock = PlaybackClock()
+        self.tuner = BufferTuner()
+        self.stats = vlc.MediaStats()
+        self.read_bytes = 0
+        self.media_bytes = 0
+        self.last_time = -1
+        self.callbacks = {}
+        self.events = Queue.Queue()
+        event_manager = self.media_player.event_manager()
+        vlc_events = (
+            (vlc.EventType.MediaPlayerPlaying, lambda event: ('state-changed', vlc.State.Playing)),
+            (vlc.EventType.MediaPlayerPaused, lambda event: ('state-changed', vlc.State.Paused)),
+            (vlc.EventType.MediaPlayerStopped, lambda event: ('state-changed', vlc.State.Stopped)),
+            (vlc.EventType.MediaPlayerEndReached, lambda event: ('eos',)),
+            (vlc.EventType.MediaPlayerEncounteredError, lambda event: ('error', 'VLC playback error')),
+            (vlc.EventType.MediaPlayerLengthChanged, lambda event: ('duration-changed', event.u.new_length)),
+            (vlc.EventType.MediaPlayerBuffering, lambda event: ('buffering', int(event.u.new_cache))),
+        )
+        for event_type, make_event in vlc_events:
+            event_manager.event_attach(event_type, lambda event, make_event=make_event:
+                                       self.events.put(make_event(event)))
+
+    def connect(self, event, callback):
+        self.callbacks.setdefault(event, []).append(callback)
+
+    def poll(self):
+        self.update_bytes()
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except Queue.Empty:
+                return
+            if event == ('state-changed', vlc.State.Playing):
+                self.clock.start()
+            elif event[0] in ('state-changed', 'eos', 'error'):
+                self.clock.stop()
+            elif event[0] == 'buffering':
+                self.tuner.set_percent(event[1], self.media_player.get_state() != vlc.State.Paused)
+            for callback in self.callbacks.get(event[0], []):
+                callback(*event[1:])
+
+    def update_bytes(self):
+        # VLC counts the bytes of each media separately, so they are added up here to keep the total going up
+        media = self.media_player.get_media()
+        if media is not None and media.get_stats(self.stats):
+            self.read_bytes += max(0, self.stats.read_bytes - self.media_bytes)
+            self.media_bytes = self.stats.read_bytes
+        self.tuner.update(self.read_bytes)
+
+    def get_buffering_stats(self):
+        """
+        :return: dict with the buffering percent, bytes downloaded, download rate, underruns and buffer duration
+        """
+        return self.tuner.get_stats()
 
     def load_url(self, url):
-        self.media_player.set_mrl(url)
+        self.clock.reset()
+        self.last_time = -1
+        self.media_bytes = 0
+        self.tuner.start_stream()
+        self.media_player.set_mrl(url, ':network-caching=%d' % self.tuner.get_buffer_duration())
+
+    def queue_url(self, url):
+        # Gapless playback is not supported by this backend
+        return False
 
     def play(self):
         if self.media_player.play() == -1:
@@ -18,15 +90,18 @@ class Player(object):
         #print state
         if state == vlc.State.Playing\
                 or state == vlc.State.Opening\
+                or state == vlc.State.Buffering\
                 or state == vlc.State.Paused:
             return True
         return False
 
     def stop(self):
+        self.clock.reset()
         self.media_player.stop()
         return True
 
     def pause(self):
+        self.clock.stop()
         self.media_player.pause()
         return True
 
@@ -37,9 +112,18 @@ class Player(object):
         return self.media_player.get_length()
 
     def get_position(self):
-        return self.media_player.get_time()
+        """
+        Gets the playback position. Never blocks.
+        :return: position in ms
+        """
+        time = self.media_player.get_time()
+        if time >= 0 and time != self.last_time:
+            self.last_time = time
+            self.clock.sync(time)
+        return self.clock.get_position()
 
     def set_position(self, position):
+        self.clock.sync(int(position))
         self.media_player.set_time(int(position))
         state = self.media_player.get_state()
         #print state
@@ -39,14 +39,23 @@ class Splash(Centerable, Tkinter.Toplevel):
 
         inset = Tkinter.Frame(self, bg='#ed7c00', padx=10, pady=10)
         inset.pack(fill=Tkinter.BOTH, expand=1)
-        message = Tkinter.Label(inset, text=message_text,
-                                font=tkFont.Font(inset, family='Times', size=23, weight='bold'),
-                                bg='#fd8c00')
-        message.pack(fill=Tkinter.BOTH, expand=1)
+        self.message = Tkinter.Label(inset, text=message_text,
+                                     font=tkFont.Font(inset, family='Times', size=23, weight='bold'),
+                                     bg='#fd8c00')
+        self.message.pack(fill=Tkinter.BOTH, expand=1)
 
         self.center()
         self.update_idletasks()
 
+    def set_message(self, message_text):
+        """
+        Changes the text shown on the splash.
+        :param message_text: new text
+        :return: None
+        """
+        self.message.config(text=message_text)
+        self.update_idletasks()
+
 
 class ChooseDevice(Centerable, Tkinter.Toplevel):
     """
@@ -0,0 +1,272 @@
+import os
+import threading
+import time
+import urllib
+import urlparse
+from collections import OrderedDict
+
+import library
+from workers import WorkerPool
+
+# Seconds a stream url is assumed to be valid for when it does not say when it expires
+STREAM_URL_TTL = 60
+# Seconds before expiring that a stream url stops being handed out
+EXPIRY_MARGIN = 15
+# Number of threads resolving stream urls ahead of time
+RESOLVER_WORKERS = 2
+# Directory and size in bytes of the cache of played audio
+AUDIO_CACHE_DIR = '.audio_cache'
+AUDIO_CACHE_SIZE = 512 * 1024 * 1024
+# Seconds since a partial file in the audio cache was last written before it is taken to be left over from a run
+# that ended, rather than in use by a running player
+STALE_AGE = 24 * 60 * 60
+# Bytes read from a stream at a time
+CHUNK_SIZE = 64 * 1024
+
+
+def get_expiry(url):
+    """
+    Gets the time a signed stream url expires, from its expire query parameter.
+    :param url: stream url
+    :return: expiry time in seconds since the epoch
+    """
+    query = urlparse.parse_qs(urlparse.urlparse(url).query)
+    try:
+        return int(query['expire'][0])
+    except (KeyError, IndexError, ValueError):
+        return time.time() + STREAM_URL_TTL
+
+
+class StreamResolver(object):
+    """
+    Gets stream urls from Google Play Music and keeps them until shortly before they expire. Urls for tracks that
+    are about to be played can be resolved ahead of time on worker threads.
+    """
+    def __init__(self, mobile_client, workers=RESOLVER_WORKERS):
+        """
+        StreamResolver __init__ function
+        :param mobile_client: GMusicAPI Mobileclient instance
+        :param workers: number of threads used by prefetch
+        :return: None
+        """
+        self.mobile_client = mobile_client
+        self.urls = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pool = WorkerPool(workers)
+
+    def fetch(self, track, device_id):
+        """
+        Asks Google Play Music for a new stream url and caches it.
+        :param track: track with an id, store id or podcast episode id
+        :param device_id: mobile device id
+        :return: stream url
+        """
+        track_id = library.get_track_id(track)
+        if 'episodeId' in track:
+            url = self.mobile_client.get_podcast_episode_stream_url(track_id, device_id)
+        else:
+            url = self.mobile_client.get_stream_url(track_id, device_id)
+        with self.lock:
+            self.urls[track_id] = (url, get_expiry(url))
+        return url
+
+    def get_cached_url(self, track):
+        """
+        Gets a cached stream url without blocking.
+        :param track: track with an id, store id or podcast episode id
+        :return: stream url, or None if there is none that is still valid for EXPIRY_MARGIN seconds
+        """
+        with self.lock:
+            cached = self.urls.get(library.get_track_id(track))
+        if cached is None or cached[1] - EXPIRY_MARGIN < time.time():
+            return None
+        return cached[0]
+
+    def get_stream_url(self, track, device_id):
+        """
+        Gets a stream url, from the cache or from a prefetch already under way if possible.
+        :param track: track with an id, store id or podcast episode id
+        :param device_id: mobile device id
+        :return: stream url
+        """
+        url = self.get_cached_url(track)
+        if url is not None:
+            return url
+        with self.lock:
+            task = self.pending.get(library.get_track_id(track))
+        if task is not None:
+            task.result()
+            url = self.get_cached_url(track)
+            if url is not None:
+                return url
+        return self.fetch(track, device_id)
+
+    def prefetch(self, tracks, device_id):
+        """
+        Resolves stream urls on the worker threads for the tracks without a valid cached url.
+        :param tracks: list of tracks
+        :param device_id: mobile device id
+        :return: None
+        """
+        for track in tracks:
+            track_id = library.get_track_id(track)
+            if track_id is None or self.get_cached_url(track) is not None:
+                continue
+            with self.lock:
+                task = self.pending.get(track_id)
+                if task is None or task.done():
+                    self.pending[track_id] = self.pool.submit(self.prefetch_one, track, device_id)
+
+    def prefetch_one(self, track, device_id):
+        try:
+            self.fetch(track, device_id)
+        except Exception, e:
+            print("Error: " + str(e))
+            print("Error resolving stream of track: " + track['title'])
+        finally:
+            with self.lock:
+                self.pending.pop(library.get_track_id(track), None)
+
+    def invalidate(self, track):
+        """
+        Forgets the cached stream url of a track, for when it stopped working before its expiry.
+        :param track: track with an id, store id or podcast episode id
+        :return: None
+        """
+        with self.lock:
+            self.urls.pop(library.get_track_id(track), None)
+
+
+class AudioCache(object):
+    """
+    Audio of played tracks kept on disk, keyed by track id. Once the files take more than max_bytes, the least
+    recently played ones are removed.
+    """
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_SIZE):
+        """
+        AudioCache __init__ function
+        :param directory: directory holding the cached files
+        :param max_bytes: size the cache is kept under
+        :return: None
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        files = []
+        now = time.time()
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            if name.endswith('.mp3'):
+                files.append((os.path.getmtime(path), name[:-len('.mp3')], os.path.getsize(path)))
+            elif now - os.path.getmtime(path) > STALE_AGE:
+                # Left over from a buffer or copy that did not finish
+                try:
+                    os.remove(path)
+                except OSError, e:
+                    print("Error: " + str(e))
+        for mtime, track_id, size in sorted(files):
+            self.entries[track_id] = size
+            self.size += size
+
+    def get_path(self, track_id):
+        return os.path.join(self.directory, track_id + '.mp3')
+
+    def __contains__(self, track):
+        with self.lock:
+            return library.get_track_id(track) in self.entries
+
+    def get_uri(self, track):
+        """
+        Gets a file uri the player can load the cached audio from, marking it as recently played.
+        :param track: track with an id, store id or podcast episode id
+        :return: file uri, or None if the track is not cached
+        """
+        track_id = library.get_track_id(track)
+        with self.lock:
+            size = self.entries.pop(track_id, None)
+            if size is None:
+                return None
+            self.entries[track_id] = size
+        path = self.get_path(track_id)
+        try:
+            os.utime(path, None)
+        except OSError:
+            with self.lock:
+                if self.entries.pop(track_id, None) is not None:
+                    self.size -= size
+            return None
+        return urlparse.urljoin('file:', urllib.pathname2url(os.path.abspath(path)))
+
+    def open(self, track):
+        """
+        Opens the cached audio of a track for reading.
+        :param track: track with an id, store id or podcast episode id
+        :return: file object, or None if the track is not cached
+        """
+        track_id = library.get_track_id(track)
+        with self.lock:
+            if track_id not in self.entries:
+                return None
+        try:
+            return open(self.get_path(track_id), 'rb')
+        except IOError:
+            return None
+
+    def store(self, track, stream):
+        """
+        Copies a stream into the cache. The file only gets its final name once the whole stream has been read, so
+        a track is never played from a partial file.
+        :param track: track with an id, store id or podcast episode id
+        :param stream: file-like object with the audio
+        :return: None
+        """
+        part_path = self.get_path(library.get_track_id(track)) + '.part'
+        with open(part_path, 'wb') as part_file:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                part_file.write(chunk)
+        self.store_file(track, part_path)
+
+    def store_file(self, track, file_path):
+        """
+        Moves a complete audio file into the cache.
+        :param track: track with an id, store id or podcast episode id
+        :param file_path: path of the file, on the same file system as the cache directory
+        :return: None
+        """
+        track_id = library.get_track_id(track)
+        path = self.get_path(track_id)
+        size = os.path.getsize(file_path)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(file_path, path)
+        with self.lock:
+            self.size -= self.entries.pop(track_id, 0)
+            self.entries[track_id] = size
+            self.size += size
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently played files until the cache fits in max_bytes. The newest file is always kept.
+        :return: None
+        """
+        while True:
+            with self.lock:
+                if self.size <= self.max_bytes or len(self.entries) <= 1:
+                    return
+                track_id, size = self.entries.popitem(last=False)
+                self.size -= size
+            try:
+                os.remove(self.get_path(track_id))
+            except OSError, e:
+                print("Error: " + str(e))
@@ -0,0 +1,98 @@
+import Queue
+import sys
+import threading
+
+
+class Task(object):
+    """
+    Function call submitted to a WorkerPool, holding its result once it has run.
+    """
+    def __init__(self, function, args, kwargs):
+        """
+        Task __init__ function
+        :param function: function to call
+        :param args: positional arguments for function
+        :param kwargs: keyword arguments for function
+        :return: None
+        """
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.error = None
+        self.finished = threading.Event()
+
+    def run(self):
+        """
+        Calls the function, keeping its return value or the exception it raised.
+        :return: None
+        """
+        try:
+            self.value = self.function(*self.args, **self.kwargs)
+        except Exception:
+            self.error = sys.exc_info()
+        self.finished.set()
+
+    def done(self):
+        """
+        :return: True if the task has run
+        """
+        return self.finished.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the task to run.
+        :param timeout: seconds to wait, or None to wait as long as it takes
+        :return: return value of the function
+        """
+        if not self.finished.wait(timeout):
+            raise RuntimeError('Task did not finish in time')
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+class WorkerPool(object):
+    """
+    Fixed number of daemon threads running submitted tasks in order.
+    """
+    def __init__(self, workers):
+        """
+        WorkerPool __init__ function
+        :param workers: number of threads
+        :return: None
+        """
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            task.run()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues a call to run on one of the threads.
+        :param function: function to call
+        :param args: positional arguments for function
+        :param kwargs: keyword arguments for function
+        :return: Task
+        """
+        task = Task(function, args, kwargs)
+        self.tasks.put(task)
+        return task
+
+    def shutdown(self):
+        """
+        Stops the threads once the tasks already queued have run.
+        :return: None
+        """
+        for _ in self.threads:
+            self.tasks.put(None)